@@ -0,0 +1,533 @@
+"""Офлайн-бенчмарк загрузчика: локальный HTTP-сервер вместо App Store, iTunes и Google Play.
+
+Сервер отдаёт синтетические фикстуры реалистичных размеров: ответы iTunes
+lookup/search, HTML страницы App Store со встроенным JSON (и .m3u8), картинки
+mzstatic / play-lh, HLS-плейлисты с сегментами. Все запросы main.py уходят на
+него через подменённый транспорт общих HTTP-сессий — хосты в URL остаются
+настоящими, поэтому группы пулов, выбор разрешения и парсинг работают как в бою.
+
+Пример:
+    python bench.py --scenarios images,appstore,gplay,hls --concurrency 1,4,8,16 \\
+        --apps 20 --latency-ms 40 --error-rate 0.01 --json bench.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from requests.adapters import HTTPAdapter
+
+import main
+
+APPSTORE_BASE_ID = 100_000_000
+SCENARIOS = ('images', 'appstore', 'gplay', 'hls', 'pipeline')
+
+
+# --- Фикстуры ---
+
+class Fixtures:
+    """Детерминированные (по seed) синтетические ответы магазинов."""
+
+    def __init__(self, apps: int, images_per_app: int, image_kb: tuple[int, int],
+                 segments: int, segment_kb: int, with_video: bool, seed: int = 1):
+        self.apps = apps
+        self.images_per_app = images_per_app
+        self.image_kb = image_kb
+        self.segments = segments
+        self.segment_kb = segment_kb
+        self.with_video = with_video
+        self.seed = seed
+        self._blobs: dict[str, bytes] = {}
+        self._lock = threading.Lock()
+
+    # Идентификаторы и URL
+
+    def appstore_ids(self) -> list[str]:
+        return [str(APPSTORE_BASE_ID + i) for i in range(self.apps)]
+
+    def gplay_ids(self) -> list[str]:
+        return [f"com.bench.app{i}" for i in range(self.apps)]
+
+    def mzstatic_urls(self, app_id: str) -> list[str]:
+        return [
+            f"https://is1-ssl.mzstatic.com/image/thumb/Purple/bench/{app_id}/screen{n}.png/392x696bb.jpg"
+            for n in range(self.images_per_app)
+        ]
+
+    def gplay_urls(self, pkg: str) -> list[str]:
+        return [f"https://play-lh.googleusercontent.com/{pkg}-{n}=w526-h296"
+                for n in range(self.images_per_app)]
+
+    def master_url(self, app_id: str) -> str:
+        return f"https://bench-hls.apple.com/{app_id}/master.m3u8"
+
+    # Тела ответов
+
+    def blob(self, key: str, size: int, header: bytes) -> bytes:
+        """Случайные байты заданного размера с сигнатурой формата (кэшируются)."""
+        with self._lock:
+            data = self._blobs.get(key)
+            if data is None:
+                rnd = random.Random(f"{self.seed}:{key}")
+                data = header + rnd.randbytes(max(0, size - len(header)))
+                self._blobs[key] = data
+            return data
+
+    def image(self, key: str) -> bytes:
+        rnd = random.Random(f"{self.seed}:size:{key}")
+        size = rnd.randint(*self.image_kb) * 1024
+        return self.blob(key, size, b'\x89PNG\r\n\x1a\n')
+
+    def lookup(self, app_id: str, country: str) -> dict:
+        idx = int(app_id) - APPSTORE_BASE_ID
+        # Каждое второе приложение — «пустой API»: скриншоты только на странице
+        shots = self.mzstatic_urls(app_id) if idx % 2 == 0 else []
+        return {
+            'trackId': int(app_id),
+            'trackName': f"Bench App {idx}",
+            'trackViewUrl': f"https://apps.apple.com/{country}/app/bench-app-{idx}/id{app_id}",
+            'screenshotUrls': shots,
+            'ipadScreenshotUrls': [],
+        }
+
+    def page(self, app_id: str) -> bytes:
+        artwork = [
+            {'url': u.rsplit('/', 1)[0] + '/{w}x{h}{c}.{f}', 'width': 1290, 'height': 2796}
+            for u in self.mzstatic_urls(app_id)
+        ]
+        data = {'data': [{'attributes': {
+            'screenshotsByType': {'iphone_6_7': artwork},
+            'artwork': {'url': 'https://is1-ssl.mzstatic.com/image/thumb/bench/AppIcon.png/{w}x{h}{c}.{f}',
+                        'width': 1024, 'height': 1024},
+            'videoPreview': self.master_url(app_id) if self.with_video else None,
+        }}]}
+        # Реальные страницы весят сотни КБ — добиваем разметкой
+        filler = '<div class="we-truncate">lorem ipsum</div>\n' * 4000
+        html = (f'<html><head><script type="application/json" id="serialized-server-data">'
+                f'{json.dumps(data)}</script></head><body>{filler}</body></html>')
+        return html.encode()
+
+    def gplay_app(self, pkg: str) -> dict:
+        return {'appId': pkg, 'title': f"Bench {pkg}", 'screenshots': self.gplay_urls(pkg)}
+
+    def master(self, app_id: str) -> bytes:
+        return (
+            '#EXTM3U\n'
+            '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="en",DEFAULT=YES,URI="audio.m3u8"\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=444x960,AUDIO="aud"\n'
+            'low.m3u8\n'
+            '#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=886x1920,AUDIO="aud"\n'
+            'video.m3u8\n'
+        ).encode()
+
+    def media(self, track: str) -> bytes:
+        lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:4', f'#EXT-X-MAP:URI="{track}_init.mp4"']
+        for n in range(self.segments):
+            lines += ['#EXTINF:4.0,', f"{track}_{n}.m4s"]
+        lines.append('#EXT-X-ENDLIST')
+        return ('\n'.join(lines) + '\n').encode()
+
+
+# --- Локальный сервер ---
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, как у настоящих CDN
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self._serve(send_body=True)
+
+    def do_HEAD(self) -> None:
+        self._serve(send_body=False)
+
+    def _serve(self, send_body: bool) -> None:
+        server: BenchServer = self.server  # type: ignore[assignment]
+        parts = urlsplit(self.path)
+        if parts.path == '/_bench/stats':
+            with server._stats_lock:
+                body = json.dumps(server.stats).encode()
+            self._reply(200, 'application/json', body, send_body)
+            return
+
+        server.count('requests')
+        if server.latency:
+            time.sleep(server.latency * random.uniform(0.5, 1.5))
+        if server.error_rate and random.random() < server.error_rate:
+            server.count('injected_errors')
+            self._reply(server.error_status, 'text/plain', b'', send_body)
+            return
+
+        host, _, path = parts.path.lstrip('/').partition('/')
+        query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        try:
+            status, ctype, body = server.route(host, '/' + path, query)
+        except Exception as e:  # фикстура не нашлась — как настоящий 404
+            status, ctype, body = 404, 'text/plain', str(e).encode()
+        server.count('bytes', len(body) if send_body else 0)
+        self._reply(status, ctype, body, send_body)
+
+    def _reply(self, status: int, ctype: str, body: bytes, send_body: bool) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body and body:
+            self.wfile.write(body)
+
+
+class BenchServer(ThreadingHTTPServer):
+    """HTTP-сервер с фикстурами, задержкой и случайными ошибками."""
+
+    daemon_threads = True
+
+    def __init__(self, fixtures: Fixtures, latency_ms: float, error_rate: float,
+                 error_status: int):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.fixtures = fixtures
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stats: dict[str, int] = {}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def count(self, key: str, n: int = 1) -> None:
+        with self._stats_lock:
+            self.stats[key] = self.stats.get(key, 0) + n
+
+    def route(self, host: str, path: str, query: dict) -> tuple[int, str, bytes]:
+        fx = self.fixtures
+        if host == 'itunes.apple.com':
+            if path == '/lookup':
+                results = [fx.lookup(i, query.get('country', 'us')) for i in query['id'].split(',')]
+            else:  # /search — «находим» первое приложение
+                results = [fx.lookup(fx.appstore_ids()[0], query.get('country', 'us'))]
+            body = json.dumps({'resultCount': len(results), 'results': results}).encode()
+            return 200, 'application/json', body
+        if host == 'apps.apple.com':
+            app_id = path.rsplit('/id', 1)[1]
+            return 200, 'text/html', fx.page(app_id)
+        if host.endswith('mzstatic.com'):
+            base = path.rsplit('/', 1)[0]
+            return 200, 'image/png', fx.image(base)
+        if host == 'play.google.com' and path == '/bench/app':
+            return 200, 'application/json', json.dumps(fx.gplay_app(query['id'])).encode()
+        if host == 'play-lh.googleusercontent.com':
+            return 200, 'image/png', fx.image(path.split('=', 1)[0])
+        if host == 'bench-hls.apple.com':
+            app_id, _, name = path.lstrip('/').partition('/')
+            if name == 'master.m3u8':
+                return 200, 'application/vnd.apple.mpegurl', fx.master(app_id)
+            if name.endswith('.m3u8'):
+                return 200, 'application/vnd.apple.mpegurl', fx.media(name[:-5])
+            return 200, 'video/mp4', fx.blob(f"{app_id}/{name}", fx.segment_kb * 1024, b'')
+        return 404, 'text/plain', b'not found'
+
+
+def _serve(conn, fixture_args: dict, latency_ms: float, error_rate: float,
+           error_status: int) -> None:
+    """Тело дочернего процесса: поднимает сервер и сообщает родителю порт."""
+    server = BenchServer(Fixtures(**fixture_args), latency_ms, error_rate, error_status)
+    conn.send(server.port)
+    server.serve_forever()
+
+
+def start_server(fixture_args: dict, latency_ms: float, error_rate: float,
+                 error_status: int) -> tuple[multiprocessing.Process, int]:
+    """Запускает сервер в отдельном процессе, чтобы его память и CPU не попадали в замеры."""
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(
+        target=_serve, args=(child, fixture_args, latency_ms, error_rate, error_status),
+        daemon=True,
+    )
+    proc.start()
+    return proc, parent.recv()
+
+
+def server_stats() -> dict:
+    """Счётчики сервера (запросы, байты, внедрённые ошибки)."""
+    return main.http_get("https://bench.local/_bench/stats").json()
+
+
+class _LocalAdapter(HTTPAdapter):
+    """Транспорт, перенаправляющий любой https://host/path на http://127.0.0.1:port/host/path."""
+
+    def __init__(self, port: int, **kwargs):
+        self.port = port
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        # Переписываем копию: снаружи запрос и ответ должны остаться с исходным
+        # URL, иначе r.url (и манифест .sync.json) указывал бы на 127.0.0.1
+        parts = urlsplit(request.url)
+        local = request.copy()
+        if parts.path.startswith('/_bench/'):
+            local.url = f"http://127.0.0.1:{self.port}{parts.path}"
+        else:
+            local.url = f"http://127.0.0.1:{self.port}/{parts.hostname}{parts.path}"
+            if parts.query:
+                local.url += f"?{parts.query}"
+        response = super().send(local, **kwargs)
+        response.url = request.url
+        response.request = request
+        return response
+
+
+def install(port: int) -> None:
+    """Переключает все HTTP-сессии main.py и google-play-scraper на локальный сервер."""
+    for group, size in main.HTTP_POOL_SIZE.items():
+        session = main.get_session(group)
+        retries = session.get_adapter('https://example.com').max_retries
+        adapter = _LocalAdapter(port, pool_connections=size, pool_maxsize=size,
+                                max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+    # google-play-scraper ходит в сеть своим клиентом — подменяем его вызовы.
+    # Слот лимитера play.google.com уже держит gplay_call, поэтому идём прямо в
+    # сессию: через http_get вызов занял бы второй слот (и второй токен)
+    def gplay_app(app_id: str, lang: str = 'en', country: str = 'us') -> dict:
+        r = main.get_session('gplay').get(
+            f"https://play.google.com/bench/app?id={app_id}&hl={lang}&gl={country}",
+            timeout=main.HTTP_TIMEOUT['gplay'])
+        r.raise_for_status()
+        return r.json()
+
+    def gplay_search(query: str, lang: str = 'en', country: str = 'us', n_hits: int = 1) -> list[dict]:
+        return [{'appId': query, 'title': query}]
+
+    main.gplay_app = gplay_app
+    main.gplay_search = gplay_search
+
+
+# --- Замеры ---
+
+class RssSampler:
+    """Пиковый RSS процесса за время замера (опрос /proc/self/status)."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_kb() -> int:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # пик за всю жизнь процесса
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak_kb = max(self.peak_kb, self.current_kb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> 'RssSampler':
+        self.peak_kb = self.current_kb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.peak_kb = max(self.peak_kb, self.current_kb())
+
+
+def _percentile(values: list[float], p: float) -> float:
+    """Процентиль методом ближайшего ранга."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[k]
+
+
+def _tree_stats(path: str, suffixes: tuple[str, ...]) -> tuple[int, int]:
+    """(количество файлов с нужными расширениями, их суммарный размер) в дереве."""
+    files = size = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            if name.endswith(suffixes):
+                files += 1
+                size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def _reset_state() -> None:
+    """Сбрасывает выученное/закэшированное между прогонами, чтобы замеры были честными."""
+    main.RESOLUTION_PROBE = main.ResolutionProbe()
+    with main._limiters_lock:
+        main._limiters.clear()  # AIMD-лимиты, урезанные прошлым прогоном
+    main.parse_appstore_page.cache_clear()
+    main.METRICS.reset()
+
+
+def run_scenario(name: str, fixtures: Fixtures, level: int, app_workers: int,
+                 out_dir: str, verbose: bool) -> dict:
+    """Один прогон сценария на уровне параллельности level."""
+    _reset_state()
+    work = os.path.join(out_dir, f"{name}_{level}")
+    os.makedirs(work, exist_ok=True)
+
+    def one(i: int) -> float:
+        started = time.perf_counter()
+        if name == 'images':
+            app_id = fixtures.appstore_ids()[i]
+            main.download_images(fixtures.mzstatic_urls(app_id), os.path.join(work, app_id),
+                                 workers=level)
+        elif name == 'appstore':
+            main.process_appstore(fixtures.appstore_ids()[i], 'us')
+        elif name == 'gplay':
+            main.process_gplay(fixtures.gplay_ids()[i], 'us')
+        elif name == 'hls':
+            app_id = fixtures.appstore_ids()[i]
+            video, audio, video_text = main._hls_media_playlists(fixtures.master_url(app_id))
+            main._fetch_hls_track(video, os.path.join(work, app_id, 'video'), video_text)
+            if audio:
+                main._fetch_hls_track(audio, os.path.join(work, app_id, 'audio'))
+        return time.perf_counter() - started
+
+    main.DOWNLOAD_WORKERS = level
+    main.HLS_SEGMENT_WORKERS = level
+    cwd = os.getcwd()
+    os.chdir(work)  # process_* пишут папки относительно текущей директории
+    sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with sink, RssSampler() as rss:
+            started = time.perf_counter()
+            if name == 'pipeline':
+                # Оба магазина одним конвейером (как --batch), --app-workers — потоков на этап
+                jobs = [{'query': q, 'store': store, 'country': 'us'}
+                        for store, ids in (('appstore', fixtures.appstore_ids()),
+                                           ('gplay', fixtures.gplay_ids()))
+                        for q in ids]
+                results = main.run_pipeline(jobs, workers=app_workers, per_host=app_workers)
+                latencies = [r['seconds'] for r in results]
+            else:
+                with ThreadPoolExecutor(max_workers=max(1, app_workers)) as pool:
+                    latencies = list(pool.map(one, range(fixtures.apps)))
+            elapsed = time.perf_counter() - started
+    finally:
+        os.chdir(cwd)
+
+    suffixes = ('.m4s', '.mp4') if name == 'hls' else ('.png', '.jpg', '.webp')
+    files, size = _tree_stats(work, suffixes)
+    return {
+        'scenario': name,
+        'concurrency': level,
+        'apps': fixtures.apps,
+        'files': files,
+        'bytes': size,
+        'seconds': round(elapsed, 3),
+        'files_per_sec': round(files / elapsed, 2) if elapsed else 0.0,
+        'mb_per_sec': round(size / elapsed / 2**20, 2) if elapsed else 0.0,
+        'p50_app_sec': round(_percentile(latencies, 50), 3),
+        'p99_app_sec': round(_percentile(latencies, 99), 3),
+        'peak_rss_mb': round(rss.peak_kb / 1024, 1),
+        'metrics': main.METRICS.snapshot(),  # разбивка по этапам (в JSON, не в таблицу)
+    }
+
+
+def _print_table(rows: list[dict]) -> None:
+    cols = ['scenario', 'concurrency', 'files', 'seconds', 'files_per_sec', 'mb_per_sec',
+            'p50_app_sec', 'p99_app_sec', 'peak_rss_mb']
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in cols}
+    print('  '.join(c.rjust(widths[c]) for c in cols))
+    for r in rows:
+        print('  '.join(str(r[c]).rjust(widths[c]) for c in cols))
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк Screenshot Downloader")
+    parser.add_argument('--scenarios', default='images,appstore,gplay',
+                        help=f"через запятую из: {', '.join(SCENARIOS)} [images,appstore,gplay]")
+    parser.add_argument('--concurrency', default='1,4,8,16',
+                        help="уровни параллельности загрузок внутри приложения [1,4,8,16]")
+    parser.add_argument('--app-workers', type=int, default=1,
+                        help="сколько приложений обрабатывается одновременно [1]")
+    parser.add_argument('--apps', type=int, default=10, help="приложений в прогоне [10]")
+    parser.add_argument('--images', type=int, default=10, help="скриншотов на приложение [10]")
+    parser.add_argument('--image-kb', default='300-2500', help="размер картинок, КБ (мин-макс) [300-2500]")
+    parser.add_argument('--segments', type=int, default=8, help="HLS-сегментов на дорожку [8]")
+    parser.add_argument('--segment-kb', type=int, default=512, help="размер HLS-сегмента, КБ [512]")
+    parser.add_argument('--with-video', action='store_true',
+                        help="добавлять .m3u8 на страницы App Store (нужен ffmpeg)")
+    parser.add_argument('--latency-ms', type=float, default=30, help="задержка ответа, мс [30]")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов с ошибкой [0]")
+    parser.add_argument('--error-status', type=int, default=503, help="код ошибочного ответа [503]")
+    parser.add_argument('--json', metavar='PATH', help="записать результаты в JSON")
+    parser.add_argument('--keep', action='store_true', help="не удалять скачанные файлы")
+    parser.add_argument('--verbose', action='store_true', help="показывать вывод main.py")
+    parser.add_argument('--rate-limits', action='store_true',
+                        help="оставить боевые HTTP_RATE_LIMIT (по умолчанию для локального сервера выключены)")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    levels = [int(x) for x in args.concurrency.split(',') if x.strip()]
+    lo, _, hi = args.image_kb.partition('-')
+
+    fixture_args = {
+        'apps': args.apps, 'images_per_app': args.images, 'image_kb': (int(lo), int(hi or lo)),
+        'segments': args.segments, 'segment_kb': args.segment_kb, 'with_video': args.with_video,
+    }
+    fixtures = Fixtures(**fixture_args)
+    proc, port = start_server(fixture_args, args.latency_ms, args.error_rate, args.error_status)
+    install(port)
+    main.META_CACHE_ENABLED = False  # метаданные тоже меряем, а не берём из кэша
+    if not args.rate_limits:
+        # Лимиты частоты рассчитаны на Apple/Google; с ними замер показал бы token bucket
+        main.HTTP_RATE_LIMIT = dict.fromkeys(main.HTTP_RATE_LIMIT, 0)
+
+    out_dir = tempfile.mkdtemp(prefix='screenshot_bench_')
+    print(f"=== Бенчмарк: сервер 127.0.0.1:{port}, файлы в {out_dir} ===")
+    rows = []
+    try:
+        for name in scenarios:
+            for level in levels:
+                row = run_scenario(name, fixtures, level, args.app_workers, out_dir, args.verbose)
+                rows.append(row)
+                print(f"--- {name} x{level}: {row['files']} файлов за {row['seconds']} с")
+        stats = server_stats()
+    finally:
+        proc.terminate()
+        if not args.keep:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+    print()
+    _print_table(rows)
+    print(f"\nЗапросов к серверу: {stats.get('requests', 0)}, "
+          f"внедрённых ошибок: {stats.get('injected_errors', 0)}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'params': vars(args), 'server': stats, 'results': rows},
+                      f, ensure_ascii=False, indent=2)
+        print(f"--- Результаты: {args.json}")
+
+
+if __name__ == "__main__":
+    main_cli()
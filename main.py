@@ -1,11 +1,35 @@
 import requests
+import hashlib
+import json
 import os
 import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, wraps
+from typing import NamedTuple
+from urllib.parse import urljoin, urlsplit
 
 from google_play_scraper import app as gplay_app, search as gplay_search
+from google_play_scraper.exceptions import NotFoundError as GooglePlayNotFound
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Настройки
 MIN_FILE_SIZE = 1500  # 1.5 KB
+DOWNLOAD_WORKERS = 8  # Сколько скриншотов качаем одновременно
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Картинки пишутся на диск потоково, такими кусками
+SYNC_STATE_FILE = '.sync.json'  # Манифест папки: что и откуда скачано
+INCREMENTAL_SYNC = False  # True — не чистить папку, а докачивать только изменения
+VIDEO_WORKERS = 2          # Сколько видео-превью качаем одновременно
+HLS_SEGMENT_WORKERS = 8    # Сколько HLS-сегментов одного превью качаем одновременно
+HLS_NATIVE = True          # Сегменты качаем сами, ffmpeg только склеивает локальные файлы
+FFMPEG_TIMEOUT = 180       # Секунд на один вызов ffmpeg
 
 # Карта country -> language для App Store URL (?l=<язык>).
 # Без этого параметра Apple часто возвращает дефолтные/английские ассеты,
@@ -63,19 +87,1151 @@ def _clean_folder(folder_name: str, prefixes: tuple[str, ...]) -> None:
                 pass
 
 
+# --- Метрики ---
+
+# Границы корзин гистограмм: длительности (секунды) и размеры (байты)
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+SIZE_BUCKETS = (10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 20_000_000)
+
+
+class Metrics:
+    """Счётчики, гистограммы и спаны этапов прогона (потокобезопасно).
+
+    Этапы (lookup, page_fetch, page_parse, image_transfer, hls_segments,
+    ffmpeg, process) меряются через span(); каждое событие спана можно
+    писать в JSON lines по ходу прогона (open_jsonl), а в конце — сводку
+    в JSON lines или текстовый файл Prometheus (write).
+    """
+
+    def __init__(self):
+        self.counters: dict[tuple, float] = {}
+        self.histograms: dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+        self._jsonl = None
+
+    def reset(self) -> None:
+        """Обнуляет счётчики и гистограммы (поток JSON lines не трогает)."""
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        bounds = SIZE_BUCKETS if name.endswith('_bytes') else DURATION_BUCKETS
+        key = self._key(name, labels)
+        with self._lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = {'bounds': bounds, 'counts': [0] * (len(bounds) + 1),
+                                            'sum': 0.0, 'count': 0}
+            idx = next((i for i, b in enumerate(bounds) if value <= b), len(bounds))
+            h['counts'][idx] += 1
+            h['sum'] += value
+            h['count'] += 1
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        """Замер этапа: гистограмма <stage>_seconds и событие в JSON lines."""
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            self.observe(f"{stage}_seconds", seconds, **labels)
+            if error:
+                self.inc('stage_errors_total', stage=stage, error=error)
+            self._emit({'type': 'span', 'stage': stage, 'seconds': round(seconds, 6),
+                        **labels, **({'error': error} if error else {})})
+
+    def timed(self, stage: str, **labels):
+        """Декоратор: весь вызов функции — один спан."""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(stage, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def open_jsonl(self, path: str) -> None:
+        """Начинает писать события спанов в path (по строке JSON на событие)."""
+        self._jsonl = open(path, 'a', encoding='utf-8')
+
+    def _emit(self, event: dict) -> None:
+        if self._jsonl is None:
+            return
+        line = json.dumps({'ts': round(time.time(), 3), **event}, ensure_ascii=False)
+        with self._lock:
+            self._jsonl.write(line + '\n')
+
+    def snapshot(self) -> dict:
+        """Текущие значения в JSON-совместимом виде."""
+        with self._lock:
+            return {
+                'counters': [{'name': n, **dict(l), 'value': v}
+                             for (n, l), v in sorted(self.counters.items())],
+                'histograms': [{'name': n, **dict(l), 'count': h['count'],
+                                'sum': round(h['sum'], 6),
+                                'buckets': dict(zip([*map(str, h['bounds']), '+Inf'], h['counts']))}
+                               for (n, l), h in sorted(self.histograms.items())],
+            }
+
+    def prometheus(self, prefix: str = 'screenshot_dl') -> str:
+        """Текстовый формат Prometheus (для node_exporter textfile collector)."""
+        def fmt(labels: tuple, extra: tuple = ()) -> str:
+            items = [*labels, *extra]
+            if not items:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in items) + '}'
+
+        lines = []
+        typed = set()
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {prefix}_{name} counter")
+                lines.append(f"{prefix}_{name}{fmt(labels)} {value}")
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {prefix}_{name} histogram")
+                cumulative = 0
+                for bound, count in zip([*map(str, h['bounds']), '+Inf'], h['counts']):
+                    cumulative += count
+                    lines.append(f"{prefix}_{name}_bucket{fmt(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{prefix}_{name}_sum{fmt(labels)} {h['sum']}")
+                lines.append(f"{prefix}_{name}_count{fmt(labels)} {h['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        """Сводка прогона: *.prom — формат Prometheus, иначе строка JSON lines."""
+        if path.endswith('.prom'):
+            tmp = f"{path}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(self.prometheus())
+            os.replace(tmp, path)  # textfile collector не должен видеть полуфайл
+            return
+        if self._jsonl is None:
+            self.open_jsonl(path)
+        self._emit({'type': 'summary', **self.snapshot()})
+        self._jsonl.flush()
+
+
+METRICS = Metrics()
+
+
+class ThreadProfiler:
+    """cProfile для всех потоков: в каждом новом потоке включается свой профайлер,
+    в конце статистика сливается в один файл .prof (смотреть: python -m pstats).
+    """
+
+    def __init__(self):
+        import cProfile
+        self._cprofile = cProfile
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def _start_in_thread(self, *_args) -> None:
+        sys.setprofile(None)
+        prof = self._cprofile.Profile()
+        try:
+            prof.enable()
+        except ValueError:  # другой профайлер уже активен (Python 3.12+)
+            return
+        with self._lock:
+            self._profiles.append(prof)
+
+    def start(self) -> None:
+        threading.setprofile(self._start_in_thread)
+        self._start_in_thread()
+
+    def stop(self, path: str) -> None:
+        import pstats
+        threading.setprofile(None)
+        stats = None
+        for prof in self._profiles:
+            prof.disable()
+            if stats is None:
+                stats = pstats.Stats(prof)
+            else:
+                stats.add(prof)
+        if stats is not None:
+            stats.dump_stats(path)
+
+
+# --- HTTP-сессии ---
+
+# Группы хостов: у каждой свой пул keep-alive соединений. Картинки с CDN качаются
+# пачками, поэтому их пулы больше, чем у API и HTML-страниц.
+HTTP_POOL_SIZE: dict[str, int] = {
+    'itunes': 4,        # itunes.apple.com (lookup/search)
+    'appstore': 4,      # apps.apple.com (HTML страниц)
+    'mzstatic': 16,     # is*-ssl.mzstatic.com (скриншоты, HLS)
+    'gplay': 4,         # play.google.com (HTML fallback)
+    'gplay_img': 16,    # play-lh.googleusercontent.com (скриншоты)
+    'default': 4,
+}
+# Таймауты (connect, read) в секундах
+HTTP_TIMEOUT: dict[str, tuple[float, float]] = {
+    'itunes': (5, 15),
+    'appstore': (5, 15),
+    'mzstatic': (5, 10),
+    'gplay': (5, 15),
+    'gplay_img': (5, 10),
+    'default': (5, 15),
+}
+HTTP_RETRIES = 3       # Повторы при сетевых ошибках и 5xx
+HTTP_BACKOFF = 0.5     # Пауза между повторами: 0.5, 1, 2 ... секунд
+
+# Лимит частоты запросов на один хост (запросов/с, 0 — без лимита) и стартовый
+# лимит одновременных запросов. Оба подстраиваются по AIMD: при 429/503
+# (а для API и страниц — и 403) делятся пополам, при успехах медленно растут
+# обратно до этих значений.
+HTTP_RATE_LIMIT: dict[str, float] = {
+    'itunes': 5,
+    'appstore': 5,
+    'mzstatic': 0,
+    'gplay': 3,
+    'gplay_img': 0,
+    'default': 0,
+}
+HTTP_MAX_CONCURRENCY: dict[str, int] = {
+    'itunes': 4,
+    'appstore': 4,
+    'mzstatic': 16,
+    'gplay': 4,
+    'gplay_img': 16,
+    'default': 8,
+}
+THROTTLE_STATUSES: dict[str, tuple[int, ...]] = {
+    'itunes': (403, 429, 503),
+    'appstore': (403, 429, 503),
+    'gplay': (403, 429, 503),
+    'default': (429, 503),
+}
+THROTTLE_RETRIES = 4       # Сколько раз переждать троттлинг, прежде чем сдаться
+THROTTLE_BACKOFF = 2.0     # Пауза после троттлинга без Retry-After (удваивается)
+
+_sessions: dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+
+
+def _host_group(url: str) -> str:
+    """Группа хостов для URL (ключ HTTP_POOL_SIZE / HTTP_TIMEOUT)."""
+    host = (urlsplit(url).hostname or '').lower()
+    if host == 'itunes.apple.com':
+        return 'itunes'
+    if host == 'apps.apple.com':
+        return 'appstore'
+    if host.endswith('.mzstatic.com'):
+        return 'mzstatic'
+    if host == 'play.google.com':
+        return 'gplay'
+    if host.endswith('.googleusercontent.com'):
+        return 'gplay_img'
+    return 'default'
+
+
+def get_session(group: str) -> requests.Session:
+    """Общая на весь процесс сессия группы хостов (пул соединений + повторы)."""
+    with _sessions_lock:
+        session = _sessions.get(group)
+        if session is None:
+            size = HTTP_POOL_SIZE.get(group, HTTP_POOL_SIZE['default'])
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=(500, 502, 504),  # 503/429 — троттлинг, см. _http_request
+                allowed_methods=frozenset({'GET', 'HEAD'}),
+                raise_on_status=False,
+                respect_retry_after_header=False,
+            )
+            adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[group] = session
+        return session
+
+
+class ThrottledError(Exception):
+    """Хост ограничивает частоту запросов (429/503/403) и не отпустил после повторов.
+
+    В отличие от «не найдено», данные могут существовать — задание стоит повторить позже.
+    """
+
+    def __init__(self, host: str, status: int | str | None = None):
+        self.host = host
+        self.status = status
+        super().__init__(f"{host}: ограничение частоты запросов ({status})")
+
+
+class HostLimiter:
+    """Token bucket + AIMD-лимит одновременных запросов для одного хоста.
+
+    Успешный ответ аддитивно увеличивает частоту и параллельность (до
+    настроенных значений), троттлинг — делит их пополам и блокирует хост на
+    Retry-After (или THROTTLE_BACKOFF с удвоением).
+    """
+
+    def __init__(self, rate: float, max_concurrency: int):
+        self.max_rate = rate
+        self.rate = rate
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.tokens = max(1.0, rate)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.backoff = THROTTLE_BACKOFF
+        self.inflight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self.max_rate:
+                    self.tokens = min(max(1.0, self.rate),
+                                      self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0 and self.inflight >= int(self.concurrency):
+                    wait = None  # ждём release()
+                elif wait <= 0 and self.max_rate and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                elif wait <= 0:
+                    if self.max_rate:
+                        self.tokens -= 1
+                    self.inflight += 1
+                    return
+                self._cond.wait(wait)
+
+    def release(self, throttled: bool = False, retry_after: float | None = None) -> None:
+        with self._cond:
+            self.inflight -= 1
+            if throttled:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                if self.max_rate:
+                    self.rate = max(self.max_rate / 16, self.rate / 2)
+                pause = retry_after if retry_after is not None else self.backoff
+                self.backoff = min(self.backoff * 2, 60.0)
+                self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                if self.max_rate:
+                    self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                self.backoff = THROTTLE_BACKOFF
+            self._cond.notify_all()
+
+
+_limiters: dict[str, HostLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host: str) -> HostLimiter:
+    """Лимитер хоста (создаётся при первом обращении, параметры — по группе хоста)."""
+    with _limiters_lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            group = _host_group(f"https://{host}/")
+            limiter = HostLimiter(HTTP_RATE_LIMIT.get(group, HTTP_RATE_LIMIT['default']),
+                                  HTTP_MAX_CONCURRENCY.get(group, HTTP_MAX_CONCURRENCY['default']))
+            _limiters[host] = limiter
+        return limiter
+
+
+def _retry_after(value: str | None) -> float | None:
+    """Retry-After: число секунд или HTTP-дата -> секунды ожидания."""
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        from email.utils import parsedate_to_datetime
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Запрос через общую сессию с лимитером хоста и обработкой троттлинга.
+
+    При 429/503 (и 403 для API/страниц) ждёт Retry-After и повторяет до
+    THROTTLE_RETRIES раз, затем бросает ThrottledError. Лимитер держит слот
+    только до получения заголовков ответа (тело stream-ответа читается вне его).
+    """
+    group = _host_group(url)
+    host = (urlsplit(url).hostname or '').lower()
+    limiter = get_limiter(host)
+    throttle_statuses = THROTTLE_STATUSES.get(group, THROTTLE_STATUSES['default'])
+    kwargs.setdefault('timeout', HTTP_TIMEOUT.get(group, HTTP_TIMEOUT['default']))
+
+    status = None
+    for _ in range(THROTTLE_RETRIES + 1):
+        limiter.acquire()
+        try:
+            r = get_session(group).request(method, url, **kwargs)
+        except BaseException:
+            limiter.release()
+            raise
+        METRICS.inc('http_requests_total', group=group, method=method, status=r.status_code)
+        retries = getattr(getattr(r.raw, 'retries', None), 'history', ())
+        if retries:
+            METRICS.inc('http_retries_total', len(retries), group=group)
+        if r.status_code not in throttle_statuses:
+            limiter.release()
+            return r
+        status = r.status_code
+        METRICS.inc('http_throttled_total', group=group, status=status)
+        limiter.release(throttled=True, retry_after=_retry_after(r.headers.get('Retry-After')))
+        r.close()
+    raise ThrottledError(host, status)
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """GET через общую сессию группы хоста; таймаут по умолчанию — из HTTP_TIMEOUT."""
+    return _http_request('GET', url, **kwargs)
+
+
+def http_head(url: str, **kwargs) -> requests.Response:
+    """HEAD через общую сессию группы хоста (дешёвая проверка без тела ответа)."""
+    kwargs.setdefault('allow_redirects', True)
+    return _http_request('HEAD', url, **kwargs)
+
+
+def gplay_call(fn, *args, **kwargs):
+    """Вызов google-play-scraper под лимитером play.google.com.
+
+    Библиотека ходит в сеть своим клиентом и выдаёт троттлинг как ExtraHTTPError
+    (429/503/403) или PlayGatewayError — такие ошибки пережидаются, а после
+    THROTTLE_RETRIES превращаются в ThrottledError. NotFoundError пробрасывается.
+    """
+    limiter = get_limiter('play.google.com')
+    error = None
+    for _ in range(THROTTLE_RETRIES + 1):
+        limiter.acquire()
+        try:
+            result = fn(*args, **kwargs)
+        except GooglePlayNotFound:
+            limiter.release()
+            raise
+        except Exception as e:
+            text = str(e)
+            if not re.search(r'\b(?:429|503|403)\b|PlayGatewayError', text):
+                limiter.release()
+                raise
+            error = text
+            METRICS.inc('http_throttled_total', group='gplay', status='scraper')
+            limiter.release(throttled=True)
+            continue
+        limiter.release()
+        return result
+    raise ThrottledError('play.google.com', error)
+
+
+# --- Кэш метаданных ---
+
+CACHE_DIR = '.cache'
+META_CACHE_PATH = os.path.join(CACHE_DIR, 'metadata.sqlite')
+META_CACHE_TTL = 24 * 3600       # Сколько секунд ответ iTunes/Google Play считается свежим
+META_CACHE_MAX_ENTRIES = 20_000  # Сверх этого вытесняются давно не читанные записи
+META_MEMO_MAX_ENTRIES = 500      # LRU в памяти: полные JSON-ответы, держим только горячие
+META_CACHE_ENABLED = True
+
+
+class MetadataCache:
+    """Кэш ответов lookup/search/gplay_app: SQLite на диске + LRU в памяти.
+
+    Ключ — (store, id-или-запрос, country, lang). Пустые ответы (None) не
+    кэшируются, чтобы временная ошибка не превращалась в «не найдено» на сутки.
+    """
+
+    def __init__(self, path: str, ttl: float = META_CACHE_TTL,
+                 max_entries: int = META_CACHE_MAX_ENTRIES,
+                 memo_entries: int = META_MEMO_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memo_entries = memo_entries
+        self._memo: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS meta ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS meta_accessed ON meta(accessed_at)")
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def make_key(store: str, ident: str, country: str, lang: str | None) -> str:
+        return json.dumps([store, ident, country.lower(), lang or ''], ensure_ascii=False)
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            hit = self._memo.get(key)
+            if hit and now - hit[0] < self.ttl:
+                self._memo.move_to_end(key)
+                return hit[1]
+            try:
+                db = self._conn()
+                row = db.execute(
+                    "SELECT value, stored_at FROM meta WHERE key = ?", (key,)
+                ).fetchone()
+                if not row or now - row[1] >= self.ttl:
+                    return None
+                db.execute("UPDATE meta SET accessed_at = ? WHERE key = ?", (now, key))
+                db.commit()
+            except sqlite3.Error:
+                return None
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+            return value
+
+    def set(self, key: str, value: dict | None) -> None:
+        if value is None:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            try:
+                db = self._conn()
+                db.execute(
+                    "INSERT OR REPLACE INTO meta (key, value, stored_at, accessed_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False, default=str), now, now),
+                )
+                (count,) = db.execute("SELECT COUNT(*) FROM meta").fetchone()
+                if count > self.max_entries:
+                    db.execute(
+                        "DELETE FROM meta WHERE key IN ("
+                        " SELECT key FROM meta ORDER BY accessed_at LIMIT ?)",
+                        (count - self.max_entries,),
+                    )
+                db.commit()
+            except sqlite3.Error:
+                pass
+
+    def _remember(self, key: str, stored_at: float, value: dict) -> None:
+        self._memo[key] = (stored_at, value)
+        self._memo.move_to_end(key)
+        while len(self._memo) > self.memo_entries:
+            self._memo.popitem(last=False)
+
+
+META_CACHE = MetadataCache(META_CACHE_PATH)
+
+
+def _cached(store: str, ident: str, country: str, lang: str | None, fetch) -> dict | None:
+    """Возвращает ответ из кэша метаданных или вызывает fetch() и кэширует результат."""
+    if not META_CACHE_ENABLED:
+        return fetch()
+    key = MetadataCache.make_key(store, ident, country, lang)
+    value = META_CACHE.get(key)
+    METRICS.inc('meta_cache_total', store=store, result='miss' if value is None else 'hit')
+    if value is None:
+        value = fetch()
+        META_CACHE.set(key, value)
+    return value
+
+
+# --- Хранилище блобов ---
+
+BLOB_STORE_DIR = os.path.join(CACHE_DIR, 'blobs')
+BLOB_STORE_ENABLED = False  # True — одинаковые картинки разных локалей хранятся один раз
+
+
+class BlobStore:
+    """Content-addressed хранилище картинок: <root>/<sha[:2]>/<sha>.<ext>.
+
+    Индекс в SQLite связывает базовый путь картинки (mzstatic без суффикса
+    размера, для Google Play — URL) с sha256 содержимого. Базовые пути Apple
+    меняются при каждой новой загрузке ассета, поэтому известный путь можно
+    не перекачивать. В папки локалей файлы попадают жёсткими ссылками (или
+    reflink/копией, если ссылку сделать нельзя).
+
+    Индекс общий для процессов (--queue --processes): ошибка SQLite или
+    файловой системы считается промахом дедупликации, а не ошибкой загрузки.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(self.root, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.root, 'index.sqlite'),
+                                       timeout=30, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                " base TEXT PRIMARY KEY, sha256 TEXT NOT NULL, ext TEXT NOT NULL,"
+                " size INTEGER NOT NULL, url TEXT)"
+            )
+            self._db.commit()
+        return self._db
+
+    def blob_path(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.root, sha256[:2], f"{sha256}.{ext}")
+
+    def link(self, base: str, dest: str) -> dict | None:
+        """Если картинка с таким базовым путём уже есть — ссылается на неё из dest.
+
+        Возвращает запись для манифеста (status 'linked') или None.
+        """
+        with self._lock:
+            try:
+                row = self._conn().execute(
+                    "SELECT sha256, ext, size, url FROM blobs WHERE base = ?", (base,)
+                ).fetchone()
+            except sqlite3.Error:
+                return None
+        if not row:
+            return None
+        sha256, ext, size, url = row
+        blob = self.blob_path(sha256, ext)
+        if not os.path.isfile(blob) or os.path.getsize(blob) != size:
+            return None
+        try:
+            _link_file(blob, dest)
+        except OSError:
+            return None
+        return {'status': 'linked', 'ext': ext, 'url': url, 'etag': None,
+                'last_modified': None, 'sha256': sha256, 'size': size}
+
+    def put(self, base: str, path: str, res: dict) -> None:
+        """Переносит скачанный файл в хранилище и заменяет его ссылкой на блоб.
+
+        Не получилось — файл в path остаётся как скачан (просто без дедупликации).
+        """
+        blob = self.blob_path(res['sha256'], res['ext'])
+        try:
+            if not os.path.isfile(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                tmp = f"{blob}.{threading.get_ident()}.tmp"
+                _link_file(path, tmp)
+                os.replace(tmp, blob)
+            # rename() между ссылками на один и тот же файл ничего не делает — пропускаем
+            if not os.path.samefile(path, blob):
+                tmp = f"{path}.blob"
+                _link_file(blob, tmp)
+                os.replace(tmp, path)
+        except OSError as e:
+            print(f"    [!] Хранилище картинок: {e}")
+            return
+        with self._lock:
+            try:
+                db = self._conn()
+                db.execute(
+                    "INSERT OR REPLACE INTO blobs (base, sha256, ext, size, url)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (base, res['sha256'], res['ext'], res['size'], res.get('url')),
+                )
+                db.commit()
+            except sqlite3.Error as e:
+                print(f"    [!] Индекс хранилища картинок: {e}")
+                try:
+                    if self._db is not None:
+                        self._db.rollback()
+                except sqlite3.Error:
+                    pass
+
+
+def _link_file(src: str, dest: str) -> None:
+    """dest -> тот же файл, что src: жёсткая ссылка, иначе reflink (Linux), иначе копия."""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        pass
+    try:
+        import fcntl
+        FICLONE = 0x40049409
+        with open(src, 'rb') as fs, open(dest, 'wb') as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        return
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dest)
+
+
+BLOB_STORE = BlobStore(BLOB_STORE_DIR)
+
+
+# --- Постобработка картинок ---
+
+POSTPROCESS_ENABLED = False           # True — после загрузки делать копии/превью (нужен Pillow)
+POSTPROCESS_DIR = 'renditions'        # Подпапка внутри папки приложения
+POSTPROCESS_FORMATS = ('webp',)       # Копии в форматах: webp, avif, png, jpg
+POSTPROCESS_SIZES = (1280,)           # Уменьшенные копии: длинная сторона, px
+POSTPROCESS_THUMB = 320               # Миниатюра <имя>_thumb.jpg (None — не делать)
+POSTPROCESS_CONTACT_SHEET = True      # contact_sheet.jpg из миниатюр всей папки
+POSTPROCESS_QUALITY = 85
+POSTPROCESS_WORKERS = None            # Процессов в пуле (None — по числу ядер)
+
+_PIL_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'avif': 'AVIF'}
+_postprocess_pool = None
+_postprocess_lock = threading.Lock()
+
+
+def has_pillow(feature: str) -> bool:
+    """Есть ли Pillow; если нет — предупреждает, что feature отключена."""
+    import importlib.util
+    if importlib.util.find_spec('PIL') is None:
+        print(f"--- [!] {feature} отключена: установите Pillow ('pip install pillow').")
+        return False
+    return True
+
+
+def _save_rendition(img, dest: str, fmt: str, quality: int) -> None:
+    """Сохраняет картинку атомарно (через временный файл) в формате fmt."""
+    pil_format = _PIL_FORMATS[fmt]
+    if pil_format == 'JPEG' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    options = {'optimize': True} if pil_format in ('JPEG', 'PNG') else {}
+    if pil_format != 'PNG':
+        options['quality'] = quality
+    tmp = f"{dest}.part"
+    img.save(tmp, format=pil_format, **options)
+    os.replace(tmp, dest)
+
+
+def render_image(path: str, out_dir: str, formats: tuple[str, ...], sizes: tuple[int, ...],
+                 thumb: int | None, quality: int) -> list[str]:
+    """Копии одной картинки: в других форматах, уменьшенные и миниатюра.
+
+    Выполняется в процессе пула (картинка декодируется один раз на все копии).
+    Возвращает пути созданных файлов.
+    """
+    from PIL import Image
+
+    stem, src_ext = os.path.splitext(os.path.basename(path))
+    outputs = []
+    with Image.open(path) as im:
+        im.load()
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+        for size in (None, *sizes):
+            if size is None:
+                img = im
+            elif max(im.size) > size:
+                img = im.copy()
+                img.thumbnail((size, size), Image.LANCZOS)
+            else:
+                continue  # меньше исходника не бывает
+            for fmt in formats:
+                if size is None and fmt == src_ext.lstrip('.').lower():
+                    continue
+                dest = os.path.join(out_dir, f"{stem}_{size}.{fmt}" if size else f"{stem}.{fmt}")
+                _save_rendition(img, dest, fmt, quality)
+                outputs.append(dest)
+        if thumb:
+            img = im.copy()
+            img.thumbnail((thumb, thumb), Image.LANCZOS)
+            dest = os.path.join(out_dir, f"{stem}_thumb.jpg")
+            _save_rendition(img, dest, 'jpg', quality)
+            outputs.append(dest)
+    return outputs
+
+
+def render_contact_sheet(thumbs: list[str], dest: str, quality: int,
+                         columns: int = 5, pad: int = 8) -> str:
+    """Склеивает миниатюры в одну картинку-сетку (в порядке списка)."""
+    from PIL import Image
+
+    images = [Image.open(p) for p in thumbs]
+    try:
+        cell_w = max(im.width for im in images)
+        cell_h = max(im.height for im in images)
+        columns = max(1, min(columns, len(images)))
+        rows = (len(images) + columns - 1) // columns
+        sheet = Image.new('RGB', (columns * (cell_w + pad) + pad, rows * (cell_h + pad) + pad), 'white')
+        for n, im in enumerate(images):
+            row, col = divmod(n, columns)
+            sheet.paste(im, (pad + col * (cell_w + pad), pad + row * (cell_h + pad)))
+        _save_rendition(sheet, dest, 'jpg', quality)
+    finally:
+        for im in images:
+            im.close()
+    return dest
+
+
+def _get_postprocess_pool():
+    """Общий пул процессов постобработки (создаётся при первой надобности).
+
+    Без Pillow возвращает None и один раз предупреждает. Процессы запускаются
+    через spawn: fork из многопоточного процесса может зависнуть на чужих блокировках.
+    """
+    global _postprocess_pool, POSTPROCESS_ENABLED
+    with _postprocess_lock:
+        if _postprocess_pool is None:
+            if not has_pillow("Постобработка"):
+                POSTPROCESS_ENABLED = False
+                return None
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            _postprocess_pool = ProcessPoolExecutor(
+                max_workers=POSTPROCESS_WORKERS or os.cpu_count(),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _postprocess_pool
+
+
+def postprocess_images(folder_name: str, files: list[str], rebuild: bool = True) -> int:
+    """Постобработка скачанных screen_* папки в пуле процессов (все ядра).
+
+    Копии пишутся в <папка>/POSTPROCESS_DIR. rebuild=False (инкрементальный
+    прогон без изменений) — ничего не делаем, если копии уже есть.
+    Возвращает количество созданных файлов.
+    """
+    out_dir = os.path.join(folder_name, POSTPROCESS_DIR)
+    if not files or (not rebuild and os.path.isdir(out_dir)):
+        return 0
+    pool = _get_postprocess_pool()
+    if pool is None:
+        return 0
+
+    # Нумерация могла сдвинуться — старые копии не переиспользуем
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir, exist_ok=True)
+    print(f"--- Постобработка {len(files)} файлов -> {out_dir} ...")
+    created = 0
+    with METRICS.span('postprocess'):
+        futures = [
+            pool.submit(render_image, os.path.join(folder_name, fname), out_dir,
+                        tuple(POSTPROCESS_FORMATS), tuple(POSTPROCESS_SIZES),
+                        POSTPROCESS_THUMB, POSTPROCESS_QUALITY)
+            for fname in files
+        ]
+        thumbs = []
+        for fname, fut in zip(files, futures):
+            try:
+                outputs = fut.result()
+            except Exception as e:
+                print(f"    [!] {fname}: {e}")
+                continue
+            created += len(outputs)
+            thumbs += [p for p in outputs if p.endswith('_thumb.jpg')]
+        if POSTPROCESS_CONTACT_SHEET and thumbs:
+            try:
+                pool.submit(render_contact_sheet, thumbs, os.path.join(out_dir, 'contact_sheet.jpg'),
+                            POSTPROCESS_QUALITY).result()
+                created += 1
+            except Exception as e:
+                print(f"    [!] contact_sheet.jpg: {e}")
+    METRICS.inc('renditions_total', created)
+    print(f"--- Постобработка: создано файлов {created}")
+    return created
+
+
+# --- Перцептивные хэши ---
+
+PHASH_ENABLED = False                 # True — искать почти одинаковые скриншоты (нужен Pillow)
+PHASH_MODE = 'flag'                   # 'flag' — пометить в .sync.json, 'drop' — не сохранять дубли внутри папки
+PHASH_PATH = os.path.join(CACHE_DIR, 'phash.sqlite')
+PHASH_MAX_DISTANCE = 6                # Порог расстояния Хэмминга между 64-битными dHash
+PHASH_BANDS = 8                       # Полос LSH: при расстоянии < PHASH_BANDS совпадение гарантировано
+PHASH_ASPECT_TOLERANCE = 0.02         # Разные пропорции (iPhone/iPad) дублями не считаются
+
+
+def image_dhash(path: str) -> dict | None:
+    """64-битный dHash картинки: {'phash', 'width', 'height'} или None (нет Pillow / не картинка).
+
+    Картинка сжимается до 9x8 в оттенках серого, бит — «пиксель ярче соседа
+    справа». С numpy биты считаются векторно, без него — в цикле по 72 пикселям.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    try:
+        with Image.open(path) as im:
+            width, height = im.size
+            im.draft('L', (64, 64))  # JPEG декодируется сразу в уменьшенном виде
+            small = im.convert('L').resize((9, 8), Image.LANCZOS)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    try:
+        import numpy as np
+    except ImportError:
+        px = list(small.getdata())
+        value = 0
+        for row in range(8):
+            for col in range(8):
+                value = (value << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    else:
+        px = np.asarray(small, dtype=np.int16)
+        value = int.from_bytes(np.packbits(px[:, :-1] > px[:, 1:]).tobytes(), 'big')
+    return {'phash': f"{value:016x}", 'width': width, 'height': height}
+
+
+def _phash_scope(folder_name: str) -> str:
+    """Область сравнения — приложение: имя папки без _<страна>_<магазин>.
+
+    Так почти-дубли ищутся между локалями и магазинами одного приложения
+    (при общем каноническом имени папок), но не между разными приложениями.
+    """
+    name = os.path.basename(os.path.normpath(folder_name))
+    m = re.match(r'^(.+)_[a-z]{2,3}_(?:appstore|gplay)$', name)
+    return m.group(1) if m else name
+
+
+class PerceptualIndex:
+    """Индекс dHash скачанных скриншотов в SQLite с LSH-полосами.
+
+    64 бита делятся на PHASH_BANDS полос; у хэшей с расстоянием меньше числа
+    полос хотя бы одна полоса совпадает. Поиск — выборка кандидатов по индексу
+    (область, полоса, значение) и точная проверка расстояния: время не зависит
+    от размера индекса.
+    """
+
+    def __init__(self, path: str, max_distance: int = PHASH_MAX_DISTANCE,
+                 bands: int = PHASH_BANDS):
+        self.path = path
+        self.max_distance = max_distance
+        self.bands = bands
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS phash ("
+                " id INTEGER PRIMARY KEY, scope TEXT NOT NULL, folder TEXT NOT NULL,"
+                " path TEXT NOT NULL, hash TEXT NOT NULL, width INTEGER, height INTEGER)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS phash_band ("
+                " scope TEXT NOT NULL, band INTEGER NOT NULL, value INTEGER NOT NULL,"
+                " image_id INTEGER NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS phash_band_lookup"
+                             " ON phash_band(scope, band, value)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS phash_folder ON phash(folder)")
+            self._db.commit()
+        return self._db
+
+    def _bands(self, value: int) -> list[tuple[int, int]]:
+        width = 64 // self.bands
+        mask = (1 << width) - 1
+        return [(b, (value >> (b * width)) & mask) for b in range(self.bands)]
+
+    def find(self, scope: str, info: dict) -> str | None:
+        """Путь ближайшего уже известного почти-дубля (или None)."""
+        value = int(info['phash'], 16)
+        aspect = info['width'] / info['height'] if info.get('height') else 0
+        best: tuple[int, str] | None = None
+        with self._lock:
+            try:
+                db = self._conn()
+                for band, band_value in self._bands(value):
+                    rows = db.execute(
+                        "SELECT p.path, p.hash, p.width, p.height FROM phash_band b"
+                        " JOIN phash p ON p.id = b.image_id"
+                        " WHERE b.scope = ? AND b.band = ? AND b.value = ?",
+                        (scope, band, band_value),
+                    ).fetchall()
+                    for path, other, width, height in rows:
+                        distance = (value ^ int(other, 16)).bit_count()
+                        if distance > self.max_distance or (best and distance >= best[0]):
+                            continue
+                        other_aspect = width / height if height else 0
+                        if aspect and abs(aspect - other_aspect) > aspect * PHASH_ASPECT_TOLERANCE:
+                            continue
+                        best = (distance, path)
+            except sqlite3.Error:
+                return None
+        return best[1] if best else None
+
+    def add(self, scope: str, folder: str, path: str, info: dict) -> None:
+        value = int(info['phash'], 16)
+        with self._lock:
+            try:
+                db = self._conn()
+                cur = db.execute(
+                    "INSERT INTO phash (scope, folder, path, hash, width, height)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (scope, folder, path, info['phash'], info.get('width'), info.get('height')),
+                )
+                db.executemany(
+                    "INSERT INTO phash_band (scope, band, value, image_id) VALUES (?, ?, ?, ?)",
+                    [(scope, band, band_value, cur.lastrowid)
+                     for band, band_value in self._bands(value)],
+                )
+                db.commit()
+            except sqlite3.Error:
+                pass
+
+    def forget_folder(self, folder: str) -> None:
+        """Убирает записи папки (перед пересинхронизацией — иначе она совпадёт сама с собой)."""
+        with self._lock:
+            try:
+                db = self._conn()
+                db.execute("DELETE FROM phash_band WHERE image_id IN"
+                           " (SELECT id FROM phash WHERE folder = ?)", (folder,))
+                db.execute("DELETE FROM phash WHERE folder = ?", (folder,))
+                db.commit()
+            except sqlite3.Error:
+                pass
+
+
+PHASH_INDEX = PerceptualIndex(PHASH_PATH)
+
+
 # --- Общие утилиты ---
 
-def get_high_res_url(url: str) -> str:
-    """Попытка улучшить качество изображения через URL."""
-    # Google Play: добавляем =w0 для оригинального размера
+# Bounding box-размеры Apple CDN по соотношению сторон скриншота (в портретной
+# ориентации, от большего к меньшему). Для альбомных картинок стороны меняются.
+APPLE_SIZE_CLASSES: dict[str, tuple[str, ...]] = {
+    'iphone': ('1320x2868', '1290x2796', '1284x2778', '1242x2688'),    # ~19.5:9
+    '16:9': ('2160x3840', '1242x2208', '1080x1920', '750x1334'),       # Apple TV, старые iPhone
+    'mac': ('1800x2880', '1600x2560', '900x1440'),                     # 16:10
+    'ipad': ('2064x2752', '2048x2732', '1668x2388', '1536x2048'),      # ~4:3
+}
+# iTunes API отдаёт превью в фиксированных bounding box, не совпадающих с
+# пропорциями самой картинки, — их класс задаём явно.
+APPLE_API_BOXES: dict[str, tuple[str, bool]] = {
+    '392x696': ('iphone', False),
+    '696x392': ('iphone', True),
+    '576x768': ('ipad', False),
+    '768x576': ('ipad', True),
+    '406x228': ('16:9', True),
+}
+
+
+# Разбор ссылок: все регулярки скомпилированы один раз, каждая ссылка
+# разбирается за один проход (parse_image_url) и результат кэшируется —
+# фильтр, дедупликация, выбор размера и загрузка берут готовую запись.
+SCREENSHOT_SKIP_PATTERNS = (
+    'AppIcon', 'favicon', 'Placeholder', 'Features',
+    'marketing', 'PurpleVideo', '{w}x{h}',
+)
+_SKIP_RE = re.compile('|'.join(map(re.escape, SCREENSHOT_SKIP_PATTERNS)))
+_SIZE_RE = re.compile(r'(\d+)x(\d+)')
+_SIZE_SEGMENT_RE = re.compile(r'/[0-9]+x[0-9]+[^/]*')
+_IMAGE_EXT_RE = re.compile(r'\.(png|jpg|jpeg|webp)$', re.IGNORECASE)
+_GPLAY_SIZE_RE = re.compile(r'=w\d+.*$')
+MZSTATIC_URL_RE = re.compile(r'https://is[0-9]-ssl\.mzstatic\.com/image/thumb/[^\s"]+\.(?:jpg|png|webp)')
+_MZSTATIC_ONLY_RE = re.compile(r'https://is[0-9]-ssl\.mzstatic\.com/image/thumb/\S+\.(?:jpg|png|webp)$')
+URL_PARSE_CACHE_SIZE = 65536  # Сколько разобранных ссылок держать в памяти
+
+
+class ImageURL(NamedTuple):
+    """Разобранная ссылка на картинку.
+
+    base — путь без суффикса размера Apple CDN (ключ дедупликации),
+    size — '392x696' или None, fmt — расширение запрошенного варианта,
+    screenshot — проходит ли ссылка фильтр скриншотов.
+    """
+    url: str
+    base: str
+    size: str | None
+    width: int
+    height: int
+    fmt: str
+    screenshot: bool
+
+
+@lru_cache(maxsize=URL_PARSE_CACHE_SIZE)
+def parse_image_url(url: str) -> ImageURL:
+    """Разбирает ссылку за один проход: (базовый путь, размер, формат, скриншот ли).
+
+    Пример: .../filename.png/300x650bb-75.webp ->
+    base='.../filename.png', size='300x650', fmt='webp'.
+    """
+    head, sep, last = url.rpartition('/')
+    m = _SIZE_RE.search(last)
+    base = head if sep and m else url
+    ext = _IMAGE_EXT_RE.search(last)
+    return ImageURL(
+        url=url,
+        base=base,
+        size=m.group(0) if m else None,
+        width=int(m.group(1)) if m else 0,
+        height=int(m.group(2)) if m else 0,
+        fmt=ext.group(1).lower() if ext else '',
+        screenshot=_SKIP_RE.search(url) is None and _IMAGE_EXT_RE.search(base) is not None,
+    )
+
+
+def _apple_size_class(url: str) -> tuple[str, bool]:
+    """Класс устройства и ориентация по суффиксу размера (.../392x696bb.jpg).
+
+    Без суффикса считаем, что это портретный скриншот iPhone.
+    """
+    rec = parse_image_url(url)
+    if not rec.size:
+        return 'iphone', False
+    if rec.size in APPLE_API_BOXES:
+        return APPLE_API_BOXES[rec.size]
+    w, h = rec.width, rec.height
+    if not w or not h:
+        return 'iphone', False
+    ratio = max(w, h) / min(w, h)
+    if ratio >= 1.9:
+        cls = 'iphone'
+    elif ratio >= 1.7:
+        cls = '16:9'
+    elif ratio >= 1.55:
+        cls = 'mac'
+    else:
+        cls = 'ipad'
+    return cls, w > h
+
+
+def _with_apple_size(url: str, size: str) -> str:
+    """Подставляет (или дописывает) суффикс размера Apple CDN."""
+    replaced, n = _SIZE_SEGMENT_RE.subn(f'/{size}bb.jpg', url)
+    return replaced if n else f"{url}/{size}bb.jpg"
+
+
+def resolution_candidates(url: str) -> tuple[tuple, list[str]]:
+    """Варианты URL от самого крупного к исходному и ключ шаблона для обучения.
+
+    Google Play: '=w0' (оригинал), затем исходный URL.
+    Apple: bounding box-размеры класса устройства (APPLE_SIZE_CLASSES), затем
+    исходный URL. Ключ — (группа хоста, класс, альбомная ли ориентация).
+    """
     if 'play-lh.googleusercontent.com' in url:
         # Убираем существующий суффикс размера, если есть
-        url = re.sub(r'=w\d+.*$', '', url)
-        return url + '=w0'
-    # Apple: заменяем или добавляем суффикс размера
-    if re.search(r'/[0-9]+x[0-9]+', url):
-        return re.sub(r'/[0-9]+x[0-9]+[^/]*', '/1284x2778bb.jpg', url)
-    return url + '/1284x2778bb.jpg'
+        return ('gplay_img',), [_GPLAY_SIZE_RE.sub('', url) + '=w0', url]
+    cls, landscape = _apple_size_class(url)
+    sizes = APPLE_SIZE_CLASSES[cls]
+    if landscape:
+        sizes = tuple('x'.join(reversed(s.split('x'))) for s in sizes)
+    return (_host_group(url), cls, landscape), [_with_apple_size(url, s) for s in sizes] + [url]
+
+
+def get_high_res_url(url: str) -> str:
+    """Попытка улучшить качество изображения через URL (самый крупный вариант)."""
+    return resolution_candidates(url)[1][0]
 
 
 def get_base_image_path(url: str) -> str:
@@ -83,24 +1239,12 @@ def get_base_image_path(url: str) -> str:
 
     Пример: .../filename.png/300x650bb-75.webp -> .../filename.png
     """
-    parts = url.rsplit('/', 1)
-    if len(parts) == 2 and re.search(r'\d+x\d+', parts[1]):
-        return parts[0]
-    return url
+    return parse_image_url(url).base
 
 
 def is_screenshot_url(url: str) -> bool:
     """Проверяет, похожа ли ссылка на скриншот (а не на иконку/баннер/плейсхолдер)."""
-    skip_patterns = [
-        'AppIcon', 'favicon', 'Placeholder', 'Features',
-        'marketing', 'PurpleVideo', '{w}x{h}',
-    ]
-    if any(p in url for p in skip_patterns):
-        return False
-    base = get_base_image_path(url)
-    if not re.search(r'\.(png|jpg|jpeg|webp)$', base, re.IGNORECASE):
-        return False
-    return True
+    return parse_image_url(url).screenshot
 
 
 def dedup_urls(raw_urls: list[str]) -> list[str]:
@@ -109,56 +1253,453 @@ def dedup_urls(raw_urls: list[str]) -> list[str]:
     Для Apple — дедупликация по базовому пути (без суффикса размера).
     Для Google Play — по полному URL.
     """
-    seen = set()
+    return filter_image_urls(raw_urls, screenshots_only=False)
+
+
+def filter_image_urls(urls, screenshots_only: bool = True) -> list[str]:
+    """Фильтр и дедупликация списка (или любого итератора) ссылок за один проход.
+
+    Каждая ссылка разбирается один раз; из дублей по базовому пути остаётся
+    первый — порядок сохраняется. screenshots_only — отбросить всё, что не
+    похоже на скриншот (иконки, плейсхолдеры, баннеры). Подходит для обработки
+    больших выгрузок: принимает генератор, например extract_mzstatic_urls(html).
+    """
+    seen: set[str] = set()
     result = []
-    for url in raw_urls:
-        key = get_base_image_path(url)
-        if key not in seen:
-            result.append(url)
-            seen.add(key)
+    for url in urls:
+        rec = parse_image_url(url)
+        if (screenshots_only and not rec.screenshot) or rec.base in seen:
+            continue
+        seen.add(rec.base)
+        result.append(url)
     return result
 
 
-def download_images(urls: list[str], folder_name: str) -> None:
-    if not urls:
-        print("--- Нет ссылок для скачивания.")
-        return
+def extract_mzstatic_urls(html: str):
+    """Лениво перебирает ссылки mzstatic на картинки в HTML (без списка всех совпадений)."""
+    for m in MZSTATIC_URL_RE.finditer(html):
+        yield m.group(0)
 
-    os.makedirs(folder_name, exist_ok=True)
-    _clean_folder(folder_name, ('screen_',))
-    print(f"--- Найдено {len(urls)} ссылок. Начинаю загрузку в '{folder_name}'...")
 
-    saved_count = 0
+def _load_sync_state(folder_name: str) -> dict:
+    """Читает манифест папки; при отсутствии/повреждении — пустой манифест."""
+    try:
+        with open(os.path.join(folder_name, SYNC_STATE_FILE), encoding='utf-8') as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_sync_state(folder_name: str, state: dict) -> None:
+    """Атомарно записывает манифест папки (через временный файл + os.replace)."""
+    path = os.path.join(folder_name, SYNC_STATE_FILE)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+class ResolutionProbe:
+    """Выбор самого крупного рабочего варианта картинки без двойных загрузок.
+
+    Для нового шаблона (хост + класс устройства + ориентация) варианты
+    проверяются дешёвыми HEAD-запросами от крупного к мелкому; первый рабочий
+    запоминается. Дальше картинки того же шаблона качаются сразу с выученным
+    размером, а при его отказе обучение сдвигается на реально сработавший.
+    Шаблон пробует один поток: остальные картинки того же шаблона ждут его
+    результат, а не шлют те же HEAD параллельно. Если HEAD не даёт ответа
+    (405/403, троттлинг, сеть), шаблон запоминается как «без HEAD»: его
+    картинки качаются GET-ом сверху вниз, без повторных проб.
+    """
+
+    def __init__(self):
+        self._learned: dict[tuple, int] = {}
+        self._probing: dict[tuple, threading.Event] = {}
+        self._no_head: set[tuple] = set()
+        self._lock = threading.Lock()
+
+    def plan(self, url: str) -> tuple[tuple, list[tuple[int, str]]]:
+        """Ключ шаблона и варианты (индекс, URL) для GET, начиная с выбранного.
+
+        Последний вариант всегда исходный URL.
+        """
+        key, candidates = resolution_candidates(url)
+        with self._lock:
+            idx = self._learned.get(key)
+            probing = self._probing.get(key)
+            owner = idx is None and probing is None and key not in self._no_head
+            if owner:
+                probing = self._probing[key] = threading.Event()
+        if owner:
+            try:
+                idx = self._probe(key, candidates)
+            finally:
+                with self._lock:
+                    del self._probing[key]
+                probing.set()
+        elif idx is None and probing is not None:
+            # Шаблон уже пробует другой поток — берём его результат без своих HEAD
+            probing.wait()
+            with self._lock:
+                idx = self._learned.get(key)
+        if idx is None:
+            with self._lock:
+                blind = key in self._no_head
+            idx = 0 if blind else len(candidates) - 1
+        return key, list(enumerate(candidates))[idx:]
+
+    def _probe(self, key: tuple, candidates: list[str]) -> int | None:
+        """HEAD-пробы от крупного к мелкому; индекс первого рабочего или None."""
+        for i, candidate in enumerate(candidates[:-1]):
+            ok = self._head_ok(candidate)
+            if ok:
+                self.confirm(key, i)
+                return i
+            if ok is None:
+                with self._lock:
+                    self._no_head.add(key)
+                return None
+        return None
+
+    def confirm(self, key: tuple, idx: int) -> None:
+        """Запоминает индекс варианта, который реально сработал для шаблона."""
+        with self._lock:
+            self._learned[key] = idx
 
-    for i, url in enumerate(urls):
-        target_url = get_high_res_url(url)
+    def forget(self, key: tuple) -> None:
+        """Сбрасывает выученный вариант — следующая картинка шаблона пробует заново."""
+        with self._lock:
+            self._learned.pop(key, None)
 
+    @staticmethod
+    def _head_ok(url: str) -> bool | None:
+        """True — вариант есть, False — точно нет (404/410, слишком мал), None — неизвестно."""
         try:
-            r = requests.get(target_url, timeout=10)
+            r = http_head(url)
+        except (requests.RequestException, ThrottledError):
+            return None
+        if r.status_code in (404, 410):
+            return False
+        if r.status_code != 200:
+            return None
+        length = r.headers.get('Content-Length', '')
+        if not length.isdigit():
+            return True  # размера нет или он битый — проверит сам GET
+        return int(length) >= MIN_FILE_SIZE
 
-            # Если high-res не сработал, берем оригинал
-            if r.status_code != 200 or len(r.content) < MIN_FILE_SIZE:
-                r = requests.get(url, timeout=10)
 
-            if len(r.content) < MIN_FILE_SIZE:
-                continue
+RESOLUTION_PROBE = ResolutionProbe()
 
-            ext = "jpg"
-            if b"PNG" in r.content[:8]: ext = "png"
-            elif b"WEBP" in r.content[:20]: ext = "webp"
 
-            filename = f"{folder_name}/screen_{saved_count + 1}.{ext}"
+def _stream_image(url: str, tmp_path: str, headers: dict | None = None) -> dict | None:
+    """Потоково качает картинку в tmp_path (чанками, без буфера в памяти).
 
-            with open(filename, 'wb') as f:
-                f.write(r.content)
+    Формат определяется по первым байтам, MIN_FILE_SIZE проверяется по счётчику
+    байт. Возвращает запись для манифеста, {'status': 'not_modified'} на 304 или
+    None, если ответ неудачный / файл слишком мал (tmp_path при этом удаляется).
+    """
+    with http_get(url, headers=headers, stream=True) as r:
+        if r.status_code == 304:
+            return {'status': 'not_modified'}
+        if r.status_code != 200:
+            return None
 
-            print(f"    [+] {filename} ({len(r.content)//1024} KB)")
-            saved_count += 1
+        head = b''
+        size = 0
+        digest = hashlib.sha256()
+        with open(tmp_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if not chunk:
+                    continue
+                if len(head) < 20:
+                    head += chunk[:20 - len(head)]
+                f.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+
+    METRICS.inc('bytes_downloaded_total', size, kind='image')
+    if size < MIN_FILE_SIZE:
+        os.remove(tmp_path)
+        return None
+    METRICS.observe('image_bytes', size)
+
+    ext = "jpg"
+    if b"PNG" in head[:8]: ext = "png"
+    elif b"WEBP" in head[:20]: ext = "webp"
+    return {
+        'status': 'new',
+        'ext': ext,
+        'url': r.url,
+        'etag': r.headers.get('ETag'),
+        'last_modified': r.headers.get('Last-Modified'),
+        'sha256': digest.hexdigest(),
+        'size': size,
+    }
 
-        except Exception as e:
-            print(f"    [!] Ошибка: {e}")
 
-    print(f"--- Готово. Скачано файлов: {saved_count}\n")
+def _fetch_image(url: str, tmp_path: str) -> dict | None:
+    """Скачивает одно изображение в tmp_path в самом крупном рабочем размере.
+
+    Размер выбирает RESOLUTION_PROBE; следующий (меньший) вариант качается,
+    только если выбранный не сработал. Возвращает запись _stream_image или None.
+    """
+    key, plan = RESOLUTION_PROBE.plan(url)
+    for idx, candidate in plan:
+        with METRICS.span('image_transfer', group=_host_group(candidate)):
+            res = _stream_image(candidate, tmp_path)
+        if res is not None:
+            if candidate != plan[0][1]:
+                METRICS.inc('highres_miss_total')
+            # Исходный URL не выучиваем: следующая картинка снова попробует крупные
+            if candidate != url:
+                RESOLUTION_PROBE.confirm(key, idx)
+            elif idx != plan[0][0]:
+                RESOLUTION_PROBE.forget(key)
+            return res
+    RESOLUTION_PROBE.forget(key)
+    METRICS.inc('image_failed_total')
+    return None
+
+
+def _sync_image(url: str, entry: dict | None, tmp_path: str) -> dict | None:
+    """Как _fetch_image, но для уже скачанного файла сначала шлёт условный запрос.
+
+    304 Not Modified (или тот же sha256) -> status 'unchanged', файл не трогаем.
+    При BLOB_STORE_ENABLED картинка, уже известная хранилищу по базовому пути,
+    не качается (status 'linked'), а скачанная — кладётся в хранилище.
+    При PHASH_ENABLED к записи добавляется dHash (считается здесь же, в потоке загрузки).
+    """
+    res = _sync_image_file(url, entry, tmp_path)
+    if PHASH_ENABLED and res and not res.get('phash') and os.path.exists(tmp_path):
+        res.update(image_dhash(tmp_path) or {})
+    return res
+
+
+def _sync_image_file(url: str, entry: dict | None, tmp_path: str) -> dict | None:
+    res = None
+    if entry:
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        res = _stream_image(entry['url'], tmp_path, headers=headers)
+        if res and res['status'] == 'not_modified':
+            return {**entry, 'status': 'unchanged'}
+        if res and res['sha256'] == entry.get('sha256'):
+            return {**res, 'status': 'unchanged'}
+
+    base = get_base_image_path(url)
+    if res is None and BLOB_STORE_ENABLED:
+        res = BLOB_STORE.link(base, tmp_path)
+        if res:
+            return res
+    if res is None:
+        res = _fetch_image(url, tmp_path)
+    if res and BLOB_STORE_ENABLED:
+        BLOB_STORE.put(base, tmp_path, res)
+    return res
+
+
+def _part_path(folder_name: str, i: int) -> str:
+    """Временный файл для i-й ссылки (в той же папке — чтобы os.replace был атомарным)."""
+    return os.path.join(folder_name, f".sync_{i}.part")
+
+
+def download_images(urls: list[str], folder_name: str,
+                    workers: int | None = None,
+                    incremental: bool | None = None,
+                    failures: list[str] | None = None) -> int:
+    """Скачивает скриншоты параллельно (не более workers потоков одновременно,
+    по умолчанию DOWNLOAD_WORKERS).
+
+    Нумерация screen_N сохраняет порядок из магазина: загрузки завершаются в
+    произвольном порядке, а номер определяется позицией ссылки среди успешных.
+
+    incremental (по умолчанию INCREMENTAL_SYNC): вместо очистки папки сверяется
+    с манифестом .sync.json — для уже скачанных картинок (по базовому пути)
+    шлётся условный запрос (ETag/Last-Modified), перекачивается только то, что
+    изменилось, а файлы перенумеровываются атомарными переименованиями.
+    При POSTPROCESS_ENABLED готовые файлы уходят в постобработку (postprocess_images).
+    failures — если передан, в него дописываются ссылки, которые не скачались;
+    если такая картинка уже была скачана раньше, прежний файл остаётся на месте.
+    Возвращает количество файлов в папке после синхронизации.
+    """
+    global PHASH_ENABLED
+    if not urls:
+        print("--- Нет ссылок для скачивания.")
+        return 0
+    if incremental is None:
+        incremental = INCREMENTAL_SYNC
+    if workers is None:
+        workers = DOWNLOAD_WORKERS
+    if PHASH_ENABLED and not has_pillow("Проверка почти-дублей"):
+        PHASH_ENABLED = False
+
+    os.makedirs(folder_name, exist_ok=True)
+    known: dict[str, dict] = {}
+    dropped: dict[str, dict] = {}  # отброшенные почти-дубли прошлого прогона (файла нет)
+    if incremental:
+        state = _load_sync_state(folder_name)
+        for entry in state.get('images', []):
+            path = os.path.join(folder_name, entry.get('file', ''))
+            if os.path.isfile(path) and os.path.getsize(path) == entry.get('size'):
+                known[entry['base']] = entry
+        if PHASH_ENABLED and PHASH_MODE == 'drop':
+            dropped = {e['base']: e for e in state.get('dropped', []) if e['base'] not in known}
+    else:
+        _clean_folder(folder_name, ('screen_',))
+    _clean_folder(folder_name, ('.sync_',))  # хвосты прерванного прогона
+    print(f"--- Найдено {len(urls)} ссылок. Начинаю загрузку в '{folder_name}'...")
+
+    bases = [get_base_image_path(url) for url in urls]
+    results: list[dict | None] = [None] * len(urls)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(_sync_image, url, known.get(base) or dropped.get(base),
+                        _part_path(folder_name, i)): i
+            for i, (url, base) in enumerate(zip(urls, bases))
+        }
+        for fut in as_completed(futures):
+            try:
+                results[futures[fut]] = fut.result()
+            except Exception as e:
+                print(f"    [!] Ошибка: {e}")
+    # Не удалось ни проверить, ни скачать заново: уже скачанный файл оставляем
+    # как есть (status 'stale') — сбой CDN не должен стирать готовые скриншоты
+    for i, (url, base) in enumerate(zip(urls, bases)):
+        if results[i] is None:
+            if failures is not None:
+                failures.append(url)
+            if base in known or base in dropped:
+                results[i] = {**(known.get(base) or dropped[base]), 'status': 'stale'}
+
+    # 1) Всё, что останется в папке, лежит под временными именами .sync_<i>.part:
+    #    новые файлы туда уже скачаны, неизменные переносим туда же — так
+    #    перенумерация не затирает файлы, которые ещё не переехали.
+    #    Неизменный отброшенный почти-дубль файла не имеет — идёт дальше без него.
+    staged: list[tuple[str | None, dict]] = []
+    for i, (base, res) in enumerate(zip(bases, results)):
+        tmp = _part_path(folder_name, i)
+        if res is None or (res['status'] in ('unchanged', 'stale') and base in dropped):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            if res is not None:
+                staged.append((None, {**dropped[base], 'base': base}))
+            continue
+        if res['status'] in ('unchanged', 'stale'):
+            os.replace(os.path.join(folder_name, known[base]['file']), tmp)
+        staged.append((tmp, {**res, 'base': base}))
+
+    # 2) Старые screen_*, которых больше нет в магазине, удаляем
+    _clean_folder(folder_name, ('screen_',))
+
+    # 3) Временные файлы -> screen_N в порядке магазина. Почти-дубли (PHASH_ENABLED)
+    #    проверяются в том же порядке: из похожих «оригинал» — более ранний.
+    #    В режиме drop отбрасываются только дубли внутри этой папки: копия из
+    #    другой локали сохраняется с пометкой, чтобы папка не осталась пустой.
+    #    Отброшенные пишутся в манифест (dropped) — их перепроверка остаётся условной.
+    scope = _phash_scope(folder_name)
+    phash_folder = os.path.abspath(folder_name)
+    if PHASH_ENABLED:
+        PHASH_INDEX.forget_folder(phash_folder)
+    entries = []
+    dropped_entries = []
+    unchanged = 0
+    linked = 0
+    similar = 0
+    stale = 0
+    renumbered = False
+    n = 0
+    for tmp, res in staged:
+        duplicate_of = None
+        if PHASH_ENABLED and tmp and not res.get('phash'):
+            res.update(image_dhash(tmp) or {})  # неизменный файл из прогона без хэшей
+        if PHASH_ENABLED and res.get('phash'):
+            duplicate_of = PHASH_INDEX.find(scope, res)
+            if duplicate_of:
+                similar += 1
+                METRICS.inc('near_duplicates_total', mode=PHASH_MODE)
+            if (PHASH_MODE == 'drop' and duplicate_of
+                    and os.path.dirname(duplicate_of) == phash_folder):
+                if tmp:
+                    os.remove(tmp)
+                print(f"    [≈] {res['url']} — почти как {duplicate_of}, не сохраняю")
+                dropped_entries.append({
+                    'base': res['base'], 'url': res['url'], 'ext': res['ext'],
+                    'etag': res.get('etag'), 'last_modified': res.get('last_modified'),
+                    'sha256': res['sha256'], 'size': res['size'], 'phash': res['phash'],
+                    'width': res['width'], 'height': res['height'],
+                    'near_duplicate_of': duplicate_of,
+                })
+                continue
+        if tmp is None:
+            # Оригинала в папке больше нет, а файла отброшенной копии и не было —
+            # без записи в манифесте следующий прогон скачает её целиком
+            print(f"    [!] {res['url']} — оригинал почти-дубля пропал, скачается в следующий раз")
+            if failures is not None:
+                failures.append(res['url'])
+            continue
+        n += 1
+        fname = f"screen_{n}.{res['ext']}"
+        filename = f"{folder_name}/{fname}"
+        os.replace(tmp, filename)
+        METRICS.inc('images_total', result=res['status'])
+        if res['status'] == 'unchanged':
+            renumbered |= known[res['base']]['file'] != fname
+            unchanged += 1
+            print(f"    [=] {filename} (без изменений)")
+        elif res['status'] == 'stale':
+            renumbered |= known[res['base']]['file'] != fname
+            stale += 1
+            print(f"    [?] {filename} (не удалось проверить — оставлен прежний файл)")
+        elif res['status'] == 'linked':
+            linked += 1
+            print(f"    [~] {filename} ({res['size']//1024} KB, из хранилища)")
+        else:
+            print(f"    [+] {filename} ({res['size']//1024} KB)")
+        if duplicate_of:
+            print(f"    [≈] {filename} почти как {duplicate_of}")
+        entry = {
+            'base': res['base'], 'url': res['url'], 'file': fname, 'ext': res['ext'], 'order': n,
+            'etag': res.get('etag'), 'last_modified': res.get('last_modified'),
+            'sha256': res['sha256'], 'size': res['size'],
+        }
+        if res.get('phash'):
+            entry.update(phash=res['phash'], width=res['width'], height=res['height'])
+            if duplicate_of:
+                entry['near_duplicate_of'] = duplicate_of
+            elif PHASH_ENABLED:
+                # В индексе только «оригиналы» — иначе при пересинхронизации папка
+                # с оригиналом совпала бы со своими же копиями в других локалях
+                PHASH_INDEX.add(scope, phash_folder, os.path.abspath(filename), res)
+        entries.append(entry)
+
+    state = _load_sync_state(folder_name)
+    state['images'] = entries
+    state['dropped'] = dropped_entries
+    _save_sync_state(folder_name, state)
+
+    if POSTPROCESS_ENABLED:
+        postprocess_images(folder_name, [e['file'] for e in entries],
+                           rebuild=(renumbered or unchanged + stale < len(entries)
+                                    or len(entries) != len(known)))
+
+    saved_count = len(entries)
+    notes = []
+    if incremental:
+        notes.append(f"без изменений: {unchanged}")
+    if stale:
+        notes.append(f"не проверено, оставлено прежних: {stale}")
+    if linked:
+        notes.append(f"из хранилища: {linked}")
+    if similar:
+        notes.append(f"почти-дублей: {similar}"
+                     + (f" (отброшено: {len(dropped_entries)})" if dropped_entries else ""))
+    suffix = f" ({', '.join(notes)})" if notes else ""
+    print(f"--- Готово. Скачано файлов: {saved_count - unchanged - stale - linked}{suffix}\n")
+    return saved_count
 
 
 # --- App Store ---
@@ -175,73 +1716,254 @@ def extract_appstore_id(query: str) -> str | None:
     return m.group(1) if m else None
 
 
+ITUNES_HEADERS = {'User-Agent': 'Mozilla/5.0'}
+ITUNES_LOOKUP_CHUNK = 100  # Сколько ID отправлять в одном lookup-запросе
+
+
 def get_appstore_data(query: str, country: str) -> dict | None:
-    """Запрос к iTunes API. Принимает чистый ID, 'idXXXX' или App Store URL."""
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    app_id = extract_appstore_id(query) if not query.isdigit() else query
-    if query.isdigit() or app_id:
-        url = f"https://itunes.apple.com/lookup?id={app_id or query}&country={country}"
+    """Запрос к iTunes API. Принимает чистый ID, 'idXXXX' или App Store URL.
+
+    Ответы кэшируются (см. MetadataCache): повторный lookup той же пары
+    (приложение, страна) не ходит в сеть. Если iTunes ограничил частоту
+    запросов — бросает ThrottledError, а не возвращает None.
+    """
+    headers = ITUNES_HEADERS
+    app_id = _appstore_lookup_id(query)
+    if app_id:
+        url = f"https://itunes.apple.com/lookup?id={app_id}&country={country}"
     else:
         url = f"https://itunes.apple.com/search?term={query}&entity=software&limit=1&country={country}"
 
-    try:
-        res = requests.get(url, headers=headers).json()
-        return res['results'][0] if res.get('resultCount', 0) > 0 else None
-    except Exception:
-        return None
+    def fetch() -> dict | None:
+        try:
+            with METRICS.span('lookup', store='appstore'):
+                res = http_get(url, headers=headers).json()
+            return res['results'][0] if res.get('resultCount', 0) > 0 else None
+        except ThrottledError:
+            raise
+        except Exception:
+            return None
 
+    return _cached('appstore', _appstore_cache_ident(query), country, None, fetch)
+
+
+def _appstore_lookup_id(query: str) -> str | None:
+    """ID для lookup-запроса: сама строка из цифр или ID из URL / 'idXXXX'."""
+    return query if query.isdigit() else extract_appstore_id(query)
 
-def parse_appstore_web(url: str) -> list[str]:
-    """Парсинг страницы App Store (fallback если API пуст)."""
-    print("   [i] API пуст. Перехожу к сканированию сайта...")
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) '
-                      'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.0 Safari/605.1.15'
-    }
-    try:
-        html = requests.get(url, headers=headers).text
-        links = re.findall(
-            r'https://is[0-9]-ssl\.mzstatic\.com/image/thumb/[^\s"]+\.(?:jpg|png|webp)', html
-        )
-        links = [u for u in links if is_screenshot_url(u)]
-        return links
-    except Exception as e:
-        print(f"Ошибка сайта: {e}")
-        return []
 
+def _appstore_cache_ident(query: str) -> str:
+    """Идентификатор запроса в кэше метаданных (общий для одиночного и пакетного lookup)."""
+    app_id = _appstore_lookup_id(query)
+    return f"id:{app_id}" if app_id else f"q:{query.strip().lower()}"
+
+
+def lookup_appstore_bulk(queries: list[str], countries: list[str],
+                         workers: int = 4) -> dict[tuple[str, str], dict | None]:
+    """Пакетный lookup: много App Store ID за один запрос к iTunes API.
+
+    Входы нормализуются через extract_appstore_id (текстовые запросы
+    пропускаются — их резолвит обычный search). Недостающие в кэше пары
+    группируются по стране и режутся на куски по ITUNES_LOOKUP_CHUNK ID;
+    куски разных стран идут параллельно (частоту держит лимитер хоста).
+    Найденное кладётся в кэш метаданных — последующие get_appstore_data
+    для этих пар в сеть не ходят.
+
+    Возвращает {(query, country): данные или None}. Пары, чей кусок не удалось
+    получить (сеть, троттлинг), в результат не попадают.
+    """
+    ids_by_query = {q: _appstore_lookup_id(q) for q in queries}
+    ids = sorted({i for i in ids_by_query.values() if i})
+    found: dict[tuple[str, str], dict | None] = {}
+
+    chunks: list[tuple[str, list[str]]] = []
+    for country in dict.fromkeys(c.lower() for c in countries):
+        pending = []
+        for app_id in ids:
+            key = MetadataCache.make_key('appstore', f"id:{app_id}", country, None)
+            cached = META_CACHE.get(key) if META_CACHE_ENABLED else None
+            if cached is not None:
+                found[(app_id, country)] = cached
+            else:
+                pending.append(app_id)
+        for i in range(0, len(pending), ITUNES_LOOKUP_CHUNK):
+            chunks.append((country, pending[i:i + ITUNES_LOOKUP_CHUNK]))
 
-def _fetch_m3u8(url: str) -> list[str]:
-    """Возвращает все .m3u8 ссылки с одной версии страницы App Store."""
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) '
-                      'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.0 Safari/605.1.15'
+    def fetch(job: tuple[str, list[str]]) -> None:
+        country, chunk = job
+        url = f"https://itunes.apple.com/lookup?id={','.join(chunk)}&country={country}"
+        try:
+            with METRICS.span('lookup_bulk', store='appstore'):
+                res = http_get(url, headers=ITUNES_HEADERS).json()
+        except Exception as e:
+            print(f"   [!] Пакетный lookup ({country.upper()}, {len(chunk)} ID): {e}")
+            return
+        by_id = {str(r.get('trackId')): r for r in res.get('results', [])}
+        for app_id in chunk:
+            data = by_id.get(app_id)
+            found[(app_id, country)] = data
+            if META_CACHE_ENABLED:
+                META_CACHE.set(MetadataCache.make_key('appstore', f"id:{app_id}", country, None), data)
+
+    if chunks:
+        print(f"   [i] Пакетный lookup: {sum(len(c) for _, c in chunks)} пар "
+              f"(приложение × страна) за {len(chunks)} запрос(ов)...")
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(fetch, chunks))
+
+    return {
+        (q, c.lower()): found[(app_id, c.lower())]
+        for q, app_id in ids_by_query.items() if app_id
+        for c in countries if (app_id, c.lower()) in found
     }
+
+
+APPSTORE_PAGE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) '
+                  'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/15.0 Safari/605.1.15'
+}
+
+
+def fetch_appstore_pages(url: str) -> dict[str, str]:
+    """Скачивает обе версии страницы продукта — по одному разу и параллельно.
+
+    Превью для iPhone и iPad живут на разных версиях страницы (по умолчанию и
+    с ?platform=ipad). Возвращает {'iPhone': html, 'iPad': html}; при ошибке
+    загрузки вместо HTML — пустая строка. Если apps.apple.com ограничил частоту
+    запросов — бросает ThrottledError (это не «страница без скриншотов»).
+    """
+    sep = '&' if '?' in url else '?'
+    variants = {'iPhone': url, 'iPad': f"{url}{sep}platform=ipad"}
+
+    def fetch(page_url: str) -> str:
+        try:
+            with METRICS.span('page_fetch'):
+                html = http_get(page_url, headers=APPSTORE_PAGE_HEADERS).text
+            METRICS.inc('bytes_downloaded_total', len(html), kind='page')
+            return html
+        except ThrottledError:
+            raise
+        except Exception as e:
+            print(f"   [!] Ошибка загрузки {page_url}: {e}")
+            return ''
+
+    with ThreadPoolExecutor(max_workers=len(variants)) as pool:
+        pages = dict(zip(variants, pool.map(fetch, variants.values())))
+    return pages
+
+
+_PAGE_JSON_RE = re.compile(r'<script[^>]+type="application/json"[^>]*>(.*?)</script>', re.S)
+_ESCAPED_SLASH_RE = re.compile(r'\\u002[fF]')
+_M3U8_URL_RE = re.compile(r'https://[^\s"\\<>]+?\.m3u8')
+
+
+def _page_json_blocks(html: str) -> list:
+    """Все JSON из <script type="application/json"> страницы (данные для гидрации)."""
+    blocks = []
+    for m in _PAGE_JSON_RE.finditer(html):
+        try:
+            blocks.append(json.loads(m.group(1)))
+        except ValueError:
+            continue
+    return blocks
+
+
+def _walk_page_json(node, in_screenshots: bool, shots: list[str], videos: list[str]) -> None:
+    """Обходит JSON страницы и собирает ссылки на скриншоты и .m3u8 (в порядке документа).
+
+    Скриншоты берутся из artwork-объектов ({template, width, height}) внутри
+    ключей со словом screenshot и из готовых mzstatic-ссылок; вложенные JSON
+    в строках (кэш shoebox) разбираются рекурсивно.
+    """
+    if isinstance(node, dict):
+        template = node.get('template') or node.get('url')
+        if in_screenshots and isinstance(template, str) and node.get('width') and node.get('height'):
+            shots.append(template.replace('{w}', str(node['width']))
+                                 .replace('{h}', str(node['height']))
+                                 .replace('{c}', 'bb').replace('{f}', 'jpg'))
+        for key, value in node.items():
+            _walk_page_json(value, in_screenshots or 'screenshot' in key.lower(), shots, videos)
+    elif isinstance(node, list):
+        for value in node:
+            _walk_page_json(value, in_screenshots, shots, videos)
+    elif isinstance(node, str):
+        if node[:1] in '{[':
+            try:
+                _walk_page_json(json.loads(node), in_screenshots, shots, videos)
+            except ValueError:
+                pass
+        elif node.endswith('.m3u8') and node.startswith('https://'):
+            videos.append(node)
+        elif '{w}' not in node and _MZSTATIC_ONLY_RE.match(node):
+            shots.append(node)
+
+
+@lru_cache(maxsize=16)
+def parse_appstore_page(html: str) -> dict[str, list[str]]:
+    """Разбирает страницу App Store за один проход: {'screenshots', 'videos'}.
+
+    Сначала — по встроенному JSON; если там пусто (старая вёрстка) — регулярками
+    по всему HTML, как раньше. Результат кэшируется: скриншоты и видео одной
+    страницы берутся из одного разбора. Возвращаемые списки не изменять.
+    """
+    with METRICS.span('page_parse'):
+        return _parse_appstore_page(html)
+
+
+def _parse_appstore_page(html: str) -> dict[str, list[str]]:
+    """Сам разбор для parse_appstore_page (без кэша и замера)."""
+    shots: list[str] = []
+    videos: list[str] = []
+    for block in _page_json_blocks(html):
+        _walk_page_json(block, False, shots, videos)
+
+    if not shots:
+        METRICS.inc('page_parse_regex_total', kind='screenshots')
+        shots = extract_mzstatic_urls(html)
+    if not videos:
+        METRICS.inc('page_parse_regex_total', kind='videos')
+        # В JSON-данных слэши экранированы — нормализуем
+        text = _ESCAPED_SLASH_RE.sub('/', html)
+        text = text.replace('\\/', '/')
+        videos = [m.group(0) for m in _M3U8_URL_RE.finditer(text)]
+
+    # srcset даёт каждую картинку в десятках размеров — оставляем по одной
+    return {'screenshots': filter_image_urls(shots), 'videos': videos}
+
+
+def parse_appstore_web(url: str, html: str | None = None) -> list[str]:
+    """Парсинг страницы App Store (fallback если API пуст).
+
+    html — уже скачанная страница (см. fetch_appstore_pages), чтобы не качать её повторно.
+    """
+    print("   [i] API пуст. Перехожу к сканированию сайта...")
+    METRICS.inc('web_fallback_total')
     try:
-        html = requests.get(url, headers=headers, timeout=15).text
+        if html is None:
+            html = http_get(url, headers=APPSTORE_PAGE_HEADERS).text
+        return parse_appstore_page(html)['screenshots']
+    except ThrottledError:
+        raise
     except Exception as e:
-        print(f"   [!] Ошибка загрузки {url}: {e}")
+        print(f"Ошибка сайта: {e}")
         return []
-    # В JSON-данных слэши экранированы — нормализуем
-    text = re.sub(r'\\u002[fF]', '/', html)
-    text = text.replace('\\/', '/')
-    return re.findall(r'https://[^\s"\\<>]+?\.m3u8', text)
 
 
-def parse_appstore_videos(url: str) -> list[str]:
+def parse_appstore_videos(url: str, pages: dict[str, str] | None = None) -> list[str]:
     """Извлекает ссылки на HLS-плейлисты (.m3u8) видео-превью со страницы App Store.
 
     iTunes Lookup API не отдаёт видео — данные лежат в JSON внутри HTML-страницы.
-    Превью для iPhone и iPad живут на разных версиях страницы (по умолчанию и
-    с ?platform=ipad), поэтому фетчим обе и склеиваем уникальные ссылки.
+    Превью для iPhone и iPad живут на разных версиях страницы, поэтому берём обе
+    (pages из fetch_appstore_pages или скачиваем сами) и склеиваем уникальные ссылки.
     """
-    sep = '&' if '?' in url else '?'
-    variants = [('iPhone', url), ('iPad', f"{url}{sep}platform=ipad")]
+    if pages is None:
+        pages = fetch_appstore_pages(url)
 
     seen: set[str] = set()
     result: list[str] = []
-    for label, v in variants:
+    for label, html in pages.items():
         new_for_variant = 0
-        for u in _fetch_m3u8(v):
+        for u in parse_appstore_page(html)['videos'] if html else []:
             if u not in seen:
                 seen.add(u)
                 result.append(u)
@@ -250,55 +1972,235 @@ def parse_appstore_videos(url: str) -> list[str]:
     return result
 
 
-def download_videos(urls: list[str], folder_name: str) -> None:
-    """Скачивает HLS-видео и собирает в .mp4 через ffmpeg (без перекодирования)."""
-    import shutil
+def _parse_hls_attrs(line: str) -> dict[str, str]:
+    """'#EXT-X-...:A=1,B="x,y"' -> {'A': '1', 'B': 'x,y'}."""
+    attrs = line.split(':', 1)[1] if ':' in line else ''
+    return {k: v.strip('"') for k, v in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', attrs)}
+
+
+def _hls_media_playlists(url: str) -> tuple[str, str | None, str | None]:
+    """По master-плейлисту выбирает самый качественный видео-вариант и его аудио.
+
+    Возвращает (URL видео-плейлиста, URL аудио-плейлиста или None, текст
+    видео-плейлиста или None). Если на входе уже media-плейлист — возвращает
+    его самого вместе с текстом, чтобы не качать его второй раз.
+    Ошибочный ответ (403/404 ...) — requests.HTTPError.
+    """
+    r = http_get(url)
+    r.raise_for_status()
+    text = r.text
+    if '#EXT-X-STREAM-INF' not in text:
+        return url, None, text
+
+    lines = text.splitlines()
+    best: tuple[int, str, str | None] | None = None
+    audio: dict[str, str] = {}
+    for i, line in enumerate(lines):
+        if line.startswith('#EXT-X-MEDIA:'):
+            attrs = _parse_hls_attrs(line)
+            if attrs.get('TYPE') == 'AUDIO' and attrs.get('URI'):
+                group = attrs.get('GROUP-ID', '')
+                if group not in audio or attrs.get('DEFAULT') == 'YES':
+                    audio[group] = urljoin(url, attrs['URI'])
+        elif line.startswith('#EXT-X-STREAM-INF:') and i + 1 < len(lines):
+            attrs = _parse_hls_attrs(line)
+            bandwidth = int(attrs.get('BANDWIDTH') or 0)
+            if best is None or bandwidth > best[0]:
+                best = (bandwidth, urljoin(url, lines[i + 1].strip()), attrs.get('AUDIO'))
+    if best is None:
+        return url, None, None
+    return best[1], audio.get(best[2]) if best[2] else None, None
+
+
+def _fetch_hls_track(url: str, track_dir: str, text: str | None = None) -> str:
+    """Качает все сегменты media-плейлиста параллельно в track_dir.
+
+    text — уже скачанный плейлист (см. _hls_media_playlists), иначе он качается.
+    Уже скачанные сегменты (от прерванного прогона) пропускаются. Пишет рядом
+    локальный index.m3u8 со ссылками на файлы и возвращает путь к нему.
+    Шифрованные плейлисты и byte-range не поддерживаются (ValueError).
+    """
+    if text is None:
+        r = http_get(url)
+        r.raise_for_status()
+        text = r.text
+    if re.search(r'#EXT-X-KEY:(?!.*METHOD=NONE)', text) or '#EXT-X-BYTERANGE' in text:
+        raise ValueError("шифрованный или byte-range плейлист")
+
+    os.makedirs(track_dir, exist_ok=True)
+    jobs: list[tuple[str, str]] = []  # (URL сегмента, локальное имя)
+    local_lines = []
+    for line in text.splitlines():
+        if line.startswith('#EXT-X-MAP:'):
+            uri = _parse_hls_attrs(line).get('URI', '')
+            name = f"init{os.path.splitext(urlsplit(uri).path)[1] or '.mp4'}"
+            jobs.append((urljoin(url, uri), name))
+            line = re.sub(r'URI="[^"]*"', f'URI="{name}"', line)
+        elif line and not line.startswith('#'):
+            ext = os.path.splitext(urlsplit(line).path)[1] or '.ts'
+            name = f"seg_{len(jobs):05d}{ext}"
+            jobs.append((urljoin(url, line.strip()), name))
+            line = name
+        local_lines.append(line)
+
+    def fetch(job: tuple[str, str]) -> None:
+        seg_url, name = job
+        path = os.path.join(track_dir, name)
+        if os.path.exists(path):
+            return
+        with http_get(seg_url, stream=True) as r:
+            r.raise_for_status()
+            size = 0
+            with open(f"{path}.part", 'wb') as f:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+        os.replace(f"{path}.part", path)
+        METRICS.inc('bytes_downloaded_total', size, kind='segment')
+
+    with METRICS.span('hls_segments'), \
+            ThreadPoolExecutor(max_workers=max(1, HLS_SEGMENT_WORKERS)) as pool:
+        list(pool.map(fetch, jobs))
+
+    index = os.path.join(track_dir, 'index.m3u8')
+    with open(index, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(local_lines) + '\n')
+    return index
+
+
+def _download_video(url: str, out_path: str, folder_name: str) -> str | None:
+    """Скачивает одно превью в out_path. Возвращает текст ошибки или None.
+
+    При HLS_NATIVE сегменты качаются нами (параллельно, с докачкой из
+    .hls_<hash>/), а ffmpeg только склеивает локальные файлы. Если плейлист
+    нам не по зубам — ffmpeg качает сам, как раньше.
+    """
     import subprocess
 
+    work_dir = os.path.join(folder_name, f".hls_{hashlib.sha1(url.encode()).hexdigest()[:12]}")
+    inputs = ['-i', url]
+    maps: list[str] = []
+    if HLS_NATIVE:
+        try:
+            video_url, audio_url, video_text = _hls_media_playlists(url)
+            inputs = ['-allowed_extensions', 'ALL', '-protocol_whitelist', 'file',
+                      '-i', _fetch_hls_track(video_url, os.path.join(work_dir, 'video'),
+                                             video_text)]
+            if audio_url:
+                inputs += ['-allowed_extensions', 'ALL', '-protocol_whitelist', 'file',
+                           '-i', _fetch_hls_track(audio_url, os.path.join(work_dir, 'audio'))]
+                maps = ['-map', '0:v:0', '-map', '1:a:0']
+        except (requests.RequestException, ValueError) as e:
+            print(f"    [i] Сегменты не скачать напрямую ({e}) — отдаю ffmpeg.")
+            inputs = ['-i', url]
+            maps = []
+
+    cmd = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        *inputs,
+        *maps,
+        '-c', 'copy',
+        '-bsf:a', 'aac_adtstoasc',
+        out_path,
+    ]
+    try:
+        with METRICS.span('ffmpeg', mode='fetch' if inputs[0] == '-i' else 'remux'):
+            res = subprocess.run(cmd, capture_output=True, text=True, timeout=FFMPEG_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return f"таймаут (>{FFMPEG_TIMEOUT}с) при скачивании {url}"
+
+    if (res.returncode == 0
+            and os.path.exists(out_path)
+            and os.path.getsize(out_path) > 10_000):
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return None
+
+    # Подчищаем пустой/битый файл; сегменты в work_dir оставляем для докачки
+    if os.path.exists(out_path):
+        os.remove(out_path)
+    err_lines = (res.stderr or '').strip().splitlines()
+    return err_lines[-1] if err_lines else 'неизвестная ошибка'
+
+
+def download_videos(urls: list[str], folder_name: str,
+                    incremental: bool | None = None,
+                    workers: int | None = None,
+                    failures: list[str] | None = None) -> int:
+    """Скачивает HLS-видео и собирает в .mp4 через ffmpeg (без перекодирования).
+
+    Превью качаются параллельно (не более workers одновременно, по умолчанию
+    VIDEO_WORKERS), нумерация
+    preview_N — в порядке ссылок. Сегменты HLS качаются пулом соединений и
+    переживают прерывание (см. _download_video).
+
+    incremental (по умолчанию INCREMENTAL_SYNC): если набор плейлистов совпадает
+    с записанным в .sync.json и все preview_* на месте — ничего не качаем.
+    failures — если передан, в него дописываются ошибки по несохранённым видео.
+    Возвращает количество сохранённых файлов.
+    """
     if not urls:
         print("--- Видео-превью не найдено.")
-        return
+        return 0
+
+    if incremental is None:
+        incremental = INCREMENTAL_SYNC
+    if incremental:
+        known = _load_sync_state(folder_name).get('videos', [])
+        if ([v.get('url') for v in known] == urls
+                and all(os.path.isfile(os.path.join(folder_name, v['file'])) for v in known)):
+            print(f"--- Видео-превью без изменений: {len(known)} шт.\n")
+            return len(known)
 
     if not shutil.which('ffmpeg'):
         print("--- [!] Найдено видео-превью, но ffmpeg не установлен — пропускаю.")
         print("    Установите: 'brew install ffmpeg' (macOS) или 'apt install ffmpeg' (Linux).")
-        return
+        if failures is not None:
+            failures.append("ffmpeg не установлен")
+        return 0
+
+    if workers is None:
+        workers = VIDEO_WORKERS
 
     os.makedirs(folder_name, exist_ok=True)
-    _clean_folder(folder_name, ('preview_',))
+    _clean_folder(folder_name, ('preview_', '.preview_'))
     print(f"--- Видео-превью: найдено {len(urls)} шт. Скачиваю через ffmpeg...")
 
+    tmp_paths = [os.path.join(folder_name, f".preview_{i}.mp4") for i in range(len(urls))]
+    errors: list[str | None] = ['не запускалось'] * len(urls)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(_download_video, url, tmp, folder_name): i
+            for i, (url, tmp) in enumerate(zip(urls, tmp_paths))
+        }
+        for fut in as_completed(futures):
+            try:
+                errors[futures[fut]] = fut.result()
+            except Exception as e:
+                errors[futures[fut]] = str(e)
+
     saved = 0
-    for url in urls:
+    entries = []
+    for url, tmp, err in zip(urls, tmp_paths, errors):
+        if err:
+            print(f"    [!] Не удалось скачать видео: {err}")
+            if failures is not None:
+                failures.append(f"{url}: {err}")
+            continue
         out_path = f"{folder_name}/preview_{saved + 1}.mp4"
-        cmd = [
-            'ffmpeg', '-y', '-loglevel', 'error',
-            '-i', url,
-            '-c', 'copy',
-            '-bsf:a', 'aac_adtstoasc',
-            out_path,
-        ]
-        try:
-            res = subprocess.run(cmd, capture_output=True, text=True, timeout=180)
-            if (res.returncode == 0
-                    and os.path.exists(out_path)
-                    and os.path.getsize(out_path) > 10_000):
-                size_kb = os.path.getsize(out_path) // 1024
-                print(f"    [+] {out_path} ({size_kb} KB)")
-                saved += 1
-            else:
-                err_lines = (res.stderr or '').strip().splitlines()
-                err = err_lines[-1] if err_lines else 'неизвестная ошибка'
-                print(f"    [!] Не удалось скачать видео: {err}")
-                # Подчищаем пустой/битый файл
-                if os.path.exists(out_path) and os.path.getsize(out_path) <= 10_000:
-                    os.remove(out_path)
-        except subprocess.TimeoutExpired:
-            print(f"    [!] Таймаут (>180с) при скачивании {url}")
-        except Exception as e:
-            print(f"    [!] Ошибка: {e}")
+        os.replace(tmp, out_path)
+        size = os.path.getsize(out_path)
+        print(f"    [+] {out_path} ({size // 1024} KB)")
+        saved += 1
+        entries.append({'url': url, 'file': os.path.basename(out_path), 'size': size})
+
+    # Манифест пишем только при полном успехе — иначе следующий прогон докачает
+    if saved == len(urls):
+        state = _load_sync_state(folder_name)
+        state['videos'] = entries
+        _save_sync_state(folder_name, state)
 
     print(f"--- Видео скачано: {saved}\n")
+    return saved
 
 
 def _clean_name(name: str) -> str:
@@ -308,6 +2210,13 @@ def _clean_name(name: str) -> str:
     ).replace(" ", "_")
 
 
+def _throttled_result(store: str, country: str, error: ThrottledError) -> dict:
+    """Сообщение и итог прогона для случая, когда магазин ограничил запросы."""
+    print(f"[!] {store} ограничивает частоту запросов ({country.upper()}): {error}. "
+          f"Повторите позже.")
+    return {'status': 'throttled', 'folder': None, 'images': 0, 'videos': 0}
+
+
 def us_appstore_name(query: str) -> str | None:
     """Каноническое имя приложения из US App Store.
 
@@ -321,22 +2230,43 @@ def us_appstore_name(query: str) -> str | None:
     return None
 
 
-def process_appstore(query: str, country: str, folder_name: str | None = None) -> None:
+@METRICS.timed('process', store='appstore')
+def process_appstore(query: str, country: str, folder_name: str | None = None) -> dict:
     """Полный пайплайн для App Store.
 
     Имя папки: по умолчанию берётся каноническое US-имя приложения (одно и то же
     для всех локалей). Можно передать готовое имя через folder_name (например,
     US-имя из App Store, чтобы и Google Play-папки назывались так же).
+
+    Этапы (appstore_resolve -> appstore_pages -> images -> videos) выполняются
+    подряд; пакетный режим гоняет те же этапы конвейером (run_pipeline).
+
+    Возвращает итог прогона: {'status', 'folder', 'images', 'videos'};
+    status 'throttled' — магазин ограничил запросы (это не «не найдено»).
     """
-    data = get_appstore_data(query, country)
+    return run_stages({'store': 'appstore', 'query': query, 'country': country,
+                       'folder_name': folder_name})
+
+
+def appstore_resolve(task: dict) -> dict:
+    """Этап 1: метаданные iTunes, имя папки и ссылки на скриншоты из API.
+
+    Если приложение не найдено или магазин ограничил запросы, в задании
+    появляется итоговый 'status' — дальнейшие этапы его пропускают.
+    """
+    query, country, folder_name = task['query'], task['country'], task.get('folder_name')
+    try:
+        data = get_appstore_data(query, country)
+        us = get_appstore_data(query, 'us') if data and not folder_name else None
+    except ThrottledError as e:
+        return {**task, **_throttled_result('App Store', country, e)}
     if not data:
         print(f"[!] Приложение не найдено в App Store ({country.upper()}).")
-        return
+        return {**task, 'status': 'not_found', 'folder': None, 'images': 0, 'videos': 0}
 
     if folder_name:
         clean_name = folder_name
     else:
-        us = get_appstore_data(query, 'us')
         clean_name = _clean_name((us or data).get('trackName', 'App'))
     folder = f"{clean_name}_{country}_appstore"
 
@@ -352,6 +2282,8 @@ def process_appstore(query: str, country: str, folder_name: str | None = None) -
         if current_list:
             raw_urls.extend(current_list)
             found_in_api = True
+    if found_in_api:
+        print(f"   [i] Найдено в API: {len(raw_urls)} шт.")
 
     # К URL страницы приклеиваем ?l=<lang> по стране — иначе Apple часто
     # отдаёт дефолтные/английские ассеты вместо локализованных.
@@ -359,16 +2291,38 @@ def process_appstore(query: str, country: str, folder_name: str | None = None) -
     lang = COUNTRY_LANG.get(country.lower(), 'en')
     web_url = _with_lang(web_url, lang) if web_url else None
 
-    if found_in_api:
-        print(f"   [i] Найдено в API: {len(raw_urls)} шт.")
-    elif web_url:
-        raw_urls.extend(parse_appstore_web(web_url))
+    return {**task, 'folder': folder, 'raw_urls': raw_urls,
+            'found_in_api': found_in_api, 'web_url': web_url}
+
+
+def appstore_pages(task: dict) -> dict:
+    """Этап 2: обе версии страницы — скриншоты (если API пуст) и ссылки на видео.
 
-    download_images(dedup_urls(raw_urls), folder)
+    Страница нужна всегда (iTunes API не отдаёт видео), поэтому качается один
+    раз; дальше по конвейеру едут только ссылки, а не HTML. Троттлинг
+    страницы завершает задание статусом 'throttled', как и троттлинг lookup.
+    """
+    web_url = task['web_url']
+    if not web_url:
+        return task
+    try:
+        pages = fetch_appstore_pages(web_url)
+        raw_urls = task['raw_urls']
+        if not task['found_in_api']:
+            raw_urls = raw_urls + parse_appstore_web(web_url, pages['iPhone'])
+    except ThrottledError as e:
+        return {**task, **_throttled_result('App Store', task['country'], e)}
+    return {**task, 'raw_urls': raw_urls, 'video_urls': parse_appstore_videos(web_url, pages)}
 
-    # Видео-превью — iTunes API их не отдаёт, всегда парсим страницу
-    if web_url:
-        download_videos(parse_appstore_videos(web_url), folder)
+
+def appstore_videos(task: dict) -> dict:
+    """Этап 4: видео-превью (HLS -> .mp4)."""
+    if task.get('video_urls') is None:  # страницы нет — и искать видео негде
+        return {**task, 'videos': 0}
+    videos = download_videos(task['video_urls'], task['folder'],
+                             incremental=task.get('incremental'),
+                             failures=task.get('video_failures'))
+    return {**task, 'videos': videos}
 
 
 # --- Google Play ---
@@ -397,20 +2351,31 @@ def get_gplay_data(query: str, country: str) -> dict | None:
     Принимает package name (com.example.app), URL Google Play или текстовый запрос.
     Язык определяется по стране через COUNTRY_LANG — иначе вернутся английские
     скриншоты, даже если у приложения есть локализованные ассеты.
+    Ответы кэшируются (см. MetadataCache).
     """
     lang = _short_lang(COUNTRY_LANG.get(country.lower(), 'en'))
+    pkg = extract_gplay_id(query)
+    ident = f"id:{pkg}" if pkg else f"q:{query.strip().lower()}"
+    return _cached('gplay', ident, country, lang,
+                   lambda: _fetch_gplay_data(query, country, lang))
 
+
+@METRICS.timed('lookup', store='gplay')
+def _fetch_gplay_data(query: str, country: str, lang: str) -> dict | None:
+    """Сетевая часть get_gplay_data (без кэша). Троттлинг -> ThrottledError."""
     # Если в строке есть package name (явный или внутри URL) — запрашиваем напрямую
     pkg = extract_gplay_id(query)
     if pkg:
         try:
-            return gplay_app(pkg, lang=lang, country=country)
+            return gplay_call(gplay_app, pkg, lang=lang, country=country)
+        except ThrottledError:
+            raise
         except Exception:
             return None
 
     # Текстовый поиск
     try:
-        results = gplay_search(query, lang=lang, country=country, n_hits=1)
+        results = gplay_call(gplay_search, query, lang=lang, country=country, n_hits=1)
         if not results:
             return None
 
@@ -420,45 +2385,65 @@ def get_gplay_data(query: str, country: str) -> dict | None:
         # Если appId найден — получаем полные данные
         if app_id:
             try:
-                return gplay_app(app_id, lang=lang, country=country)
+                return gplay_call(gplay_app, app_id, lang=lang, country=country)
+            except ThrottledError:
+                raise
             except Exception:
                 return result
 
         # appId=None (бывает у некоторых приложений) — ищем package name в HTML
-        html = requests.get(
+        html = http_get(
             f'https://play.google.com/store/search?q={query}&c=apps&hl={lang}&gl={country}',
             headers={'User-Agent': 'Mozilla/5.0'}
         ).text
         ids = re.findall(r'/store/apps/details\?id=([a-zA-Z0-9_.]+)', html)
         if ids:
             try:
-                return gplay_app(ids[0], lang=lang, country=country)
+                return gplay_call(gplay_app, ids[0], lang=lang, country=country)
+            except ThrottledError:
+                raise
             except Exception:
                 pass
 
         # Последний fallback — данные из поиска
         return result
+    except ThrottledError:
+        raise
     except Exception:
         return None
 
 
-def process_gplay(query: str, country: str, folder_name: str | None = None) -> None:
+@METRICS.timed('process', store='gplay')
+def process_gplay(query: str, country: str, folder_name: str | None = None) -> dict:
     """Полный пайплайн для Google Play.
 
     Имя папки: по умолчанию берётся US-имя приложения из Google Play (одно и то же
     для всех локалей). Можно передать готовое имя через folder_name — например,
     каноническое US-имя из App Store, чтобы папки игры назывались одинаково
     в обоих магазинах.
+
+    Возвращает итог прогона: {'status', 'folder', 'images', 'videos'};
+    status 'throttled' — магазин ограничил запросы (это не «не найдено»).
     """
-    data = get_gplay_data(query, country)
+    return run_stages({'store': 'gplay', 'query': query, 'country': country,
+                       'folder_name': folder_name})
+
+
+def gplay_resolve(task: dict) -> dict:
+    """Этап 1: данные приложения из Google Play, имя папки и ссылки на скриншоты."""
+    query, country, folder_name = task['query'], task['country'], task.get('folder_name')
+    try:
+        data = get_gplay_data(query, country)
+        us = get_gplay_data(query, 'us') if data and not folder_name else None
+    except ThrottledError as e:
+        return {**task, **_throttled_result('Google Play', country, e)}
     if not data:
         print(f"[!] Приложение не найдено в Google Play ({country.upper()}).")
-        return
+        return {**task, 'status': 'not_found', 'folder': None, 'images': 0, 'videos': 0}
 
     if folder_name:
         clean_name = folder_name
     else:
-        us = get_gplay_data(query, 'us')
         clean_name = _clean_name((us or data).get('title', 'App'))
     folder = f"{clean_name}_{country}_gplay"
 
@@ -467,15 +2452,711 @@ def process_gplay(query: str, country: str, folder_name: str | None = None) -> N
     raw_urls = data.get('screenshots', [])
     if not raw_urls:
         print("   [!] Скриншоты не найдены.")
-        return
+        return {**task, 'status': 'no_screenshots', 'folder': folder, 'images': 0, 'videos': 0}
 
     print(f"   [i] Найдено скриншотов: {len(raw_urls)} шт.")
-    download_images(dedup_urls(raw_urls), folder)
+    return {**task, 'folder': folder, 'raw_urls': raw_urls}
+
+
+# --- Пакетный режим ---
+
+BATCH_WORKERS = 4     # Сколько заданий (приложение × страна × магазин) на каждом этапе конвейера
+BATCH_PER_HOST = 2    # Не больше стольких заданий одного магазина на этапе
+
+# Магазин -> хост, по которому считается лимит параллельности
+STORE_HOSTS: dict[str, str] = {
+    'appstore': 'apps.apple.com',
+    'gplay': 'play.google.com',
+}
+
+_STORE_ALIASES: dict[str, tuple[str, ...]] = {
+    'a': ('appstore',), 'appstore': ('appstore',),
+    'g': ('gplay',), 'gplay': ('gplay',),
+    'both': ('appstore', 'gplay'),
+}
+
+
+def _split_countries(value) -> list[str]:
+    """'us ru;de' / ['us', 'ru'] / 'all' -> список кодов стран."""
+    if isinstance(value, str):
+        value = re.split(r'[\s,;|]+', value)
+    countries = [c.strip().lower() for c in (value or []) if c and c.strip()]
+    if 'all' in countries:
+        return list(COUNTRY_LANG)
+    return countries or ['us']
+
+
+def load_manifest(path: str) -> list[dict]:
+    """Читает манифест пакетного режима и разворачивает его в список заданий.
+
+    Каждая строка манифеста: query, store (a/g/appstore/gplay/both) и список
+    стран (через пробел, ';' или '|'; 'all' — все страны из COUNTRY_LANG).
+    Форматы по расширению файла:
+      - .csv  — колонки query,store,countries (заголовок обязателен);
+      - .json — список объектов; .jsonl — по объекту в строке;
+      - .yaml/.yml — список объектов (нужен PyYAML).
+    Возвращает задания вида {'query', 'store', 'country'}.
+    """
+    import csv
+
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, encoding='utf-8') as f:
+        if ext == '.csv':
+            rows = list(csv.DictReader(f))
+        elif ext == '.jsonl':
+            rows = [json.loads(line) for line in f if line.strip()]
+        elif ext == '.json':
+            rows = json.load(f)
+        elif ext in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise RuntimeError("Для YAML-манифеста установите PyYAML: 'pip install pyyaml'.")
+            rows = yaml.safe_load(f) or []
+        else:
+            raise ValueError(f"Неизвестный формат манифеста: {ext or path}")
+
+    jobs: list[dict] = []
+    for n, row in enumerate(rows, 1):
+        query = str(row.get('query') or '').strip()
+        if not query:
+            continue
+        store_key = str(row.get('store') or 'a').strip().lower()
+        stores = _STORE_ALIASES.get(store_key)
+        if not stores:
+            raise ValueError(f"Строка {n}: неизвестный магазин '{store_key}'.")
+        for country in _split_countries(row.get('countries') or row.get('country')):
+            for store in stores:
+                jobs.append({'query': query, 'store': store, 'country': country})
+    return jobs
+
+
+def download_task_images(task: dict) -> dict:
+    """Этап 3 (оба магазина): скриншоты задания."""
+    images = download_images(dedup_urls(task['raw_urls']), task['folder'],
+                             incremental=task.get('incremental'),
+                             failures=task.get('image_failures'))
+    return {**task, 'images': images}
+
+
+# Этапы конвейера: (имя, {магазин: функция task -> task}). Магазин без функции
+# на этапе проходит его насквозь; задание с итоговым 'status' — тоже.
+PIPELINE_STAGES: tuple[tuple[str, dict], ...] = (
+    ('resolve', {'appstore': appstore_resolve, 'gplay': gplay_resolve}),
+    ('pages', {'appstore': appstore_pages}),
+    ('images', {'appstore': download_task_images, 'gplay': download_task_images}),
+    ('videos', {'appstore': appstore_videos}),
+)
+PIPELINE_QUEUE_SIZE = 4  # Сколько заданий может ждать перед каждым этапом (backpressure)
+
+
+def _task_result(task: dict) -> dict:
+    """Итог задания в формате process_*: {'status', 'folder', 'images', 'videos'}
+    (+ 'same_as' для локали, совпавшей с уже скачанной, см. run_sweep)."""
+    result = {'status': task.get('status', 'ok'), 'folder': task.get('folder'),
+              'images': task.get('images', 0), 'videos': task.get('videos', 0)}
+    if task.get('same_as'):
+        result['same_as'] = task['same_as']
+    return result
+
+
+def run_stages(task: dict) -> dict:
+    """Прогоняет одно задание по всем этапам подряд (без конвейера)."""
+    for _name, handlers in PIPELINE_STAGES:
+        if 'status' in task:
+            break
+        handler = handlers.get(task['store'])
+        if handler:
+            task = handler(task)
+    return _task_result(task)
+
+
+def run_pipeline(jobs: list[dict], workers: int = BATCH_WORKERS,
+                 per_host: int = BATCH_PER_HOST,
+                 queue_size: int | None = None,
+                 stages: tuple[tuple[str, dict], ...] = PIPELINE_STAGES) -> list[dict]:
+    """Конвейер заданий: у каждого этапа свои потоки и ограниченная очередь.
+
+    Пока у приложения A качаются скриншоты, у B разбирается страница, а у C
+    идёт lookup — сеть не простаивает в ожидании предыдущего шага. На каждом
+    этапе workers потоков, и не больше per_host заданий одного магазина
+    одновременно. Очереди между этапами ограничены queue_size (по умолчанию
+    PIPELINE_QUEUE_SIZE): быстрый этап ждёт медленный, и в памяти не копятся
+    ссылки сотен приложений. Ошибка задания не останавливает конвейер.
+
+    stages — этапы (по умолчанию PIPELINE_STAGES; run_sweep вставляет свой).
+    Возвращает результаты в порядке jobs: задание + итог process_* + 'error'
+    и 'seconds'.
+    """
+    import queue
+
+    if queue_size is None:
+        queue_size = PIPELINE_QUEUE_SIZE
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    done = object()
+    results: list[dict | None] = [None] * len(jobs)
+
+    def worker(k: int, limits: dict[str, threading.BoundedSemaphore]) -> None:
+        name, handlers = stages[k]
+        while True:
+            item = queues[k].get()
+            if item is done:
+                return
+            i, task = item
+            handler = handlers.get(task['store'])
+            if handler and 'status' not in task:
+                try:
+                    with limits[STORE_HOSTS[task['store']]], \
+                            METRICS.span(f'pipeline_{name}', store=task['store']):
+                        task = handler(task)
+                except Exception as e:
+                    task = {**task, 'status': 'error', 'error': str(e)}
+            if k + 1 < len(stages):
+                queues[k + 1].put((i, task))
+            else:
+                results[i] = {**jobs[i], **_task_result(task), 'error': task.get('error'),
+                              'seconds': round(time.monotonic() - task['started'], 2)}
+
+    pools = []
+    for k in range(len(stages)):
+        limits = {h: threading.BoundedSemaphore(max(1, per_host)) for h in STORE_HOSTS.values()}
+        threads = [threading.Thread(target=worker, args=(k, limits), daemon=True)
+                   for _ in range(max(1, workers))]
+        for t in threads:
+            t.start()
+        pools.append(threads)
+
+    for i, job in enumerate(jobs):
+        queues[0].put((i, {**job, 'started': time.monotonic()}))
+    # Этап k закончен, когда все его потоки получили «стоп» и вышли
+    for k, threads in enumerate(pools):
+        for _ in threads:
+            queues[k].put(done)
+        for t in threads:
+            t.join()
+    return results
+
+
+def run_batch(manifest_path: str, workers: int = BATCH_WORKERS,
+              per_host: int = BATCH_PER_HOST, report_path: str | None = None) -> list[dict]:
+    """Неинтерактивный прогон всех заданий манифеста конвейером (run_pipeline).
+
+    workers — число потоков на каждом этапе конвейера, per_host — лимит
+    заданий одного магазина на этапе. В конце печатается сводка и пишется JSON-отчёт
+    (по умолчанию batch_report_<время>.json рядом с манифестом).
+    """
+    jobs = load_manifest(manifest_path)
+    if not jobs:
+        print("--- Манифест пуст.")
+        return []
+
+    print(f"=== Пакетный режим: {len(jobs)} заданий, потоков {workers}, "
+          f"на магазин {per_host} ===")
+    started = time.monotonic()
+
+    # Метаданные App Store (и US-имена для папок) — заранее, пачками по стране
+    appstore_jobs = [j for j in jobs if j['store'] == 'appstore']
+    if appstore_jobs and META_CACHE_ENABLED:
+        lookup_appstore_bulk(list({j['query'] for j in appstore_jobs}),
+                             list({j['country'] for j in appstore_jobs} | {'us'}))
+
+    results = run_pipeline(jobs, workers=workers, per_host=per_host)  # порядок — как в манифесте
+
+    if not report_path:
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        report_path = os.path.join(os.path.dirname(os.path.abspath(manifest_path)),
+                                   f"batch_report_{stamp}.json")
+    _finish_report(results, started, report_path)
+    return results
+
+
+def _finish_report(results: list[dict], started: float, report_path: str | None) -> dict:
+    """Сводка прогона: печатает итог и проблемные задания, пишет JSON-отчёт (если задан путь)."""
+    summary = {
+        'jobs': len(results),
+        'ok': sum(r['status'] == 'ok' for r in results),
+        'failed': sum(r['status'] != 'ok' for r in results),
+        'throttled': sum(r['status'] == 'throttled' for r in results),
+        'duplicates': sum(bool(r.get('same_as')) for r in results),
+        'images': sum(r['images'] for r in results),
+        'videos': sum(r['videos'] for r in results),
+        'seconds': round(time.monotonic() - started, 2),
+    }
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump({'summary': summary, 'jobs': results}, f, ensure_ascii=False, indent=2)
+
+    duplicates = f", совпавших локалей {summary['duplicates']}" if summary['duplicates'] else ""
+    print(f"\n=== Итог: заданий {summary['jobs']}, успешно {summary['ok']}, "
+          f"с ошибками {summary['failed']} (из них троттлинг {summary['throttled']}), "
+          f"скриншотов {summary['images']}, "
+          f"видео {summary['videos']}{duplicates}, за {summary['seconds']} с ===")
+    for r in results:
+        if r['status'] != 'ok':
+            print(f"    [!] {r['query']} / {r['store']} / {r['country']}: "
+                  f"{r['error'] or r['status']}")
+    if report_path:
+        print(f"--- Отчёт: {report_path}")
+    return summary
+
+
+# --- Обход стран ---
+
+SWEEP_LINK_DUPLICATES = True  # True — в папку совпавшей локали кладутся ссылки на файлы первой
+
+
+def sweep_canonical_name(query: str, stores: tuple[str, ...]) -> str | None:
+    """Имя папок для обхода — один раз на все страны и оба магазина.
+
+    Берётся US-имя из App Store (если он в обходе), иначе US-имя из Google Play.
+    """
+    name = None
+    try:
+        if 'appstore' in stores:
+            name = us_appstore_name(query)
+        if not name and 'gplay' in stores:
+            data = get_gplay_data(query, 'us')
+            name = _clean_name(data['title']) if data and data.get('title') else None
+    except ThrottledError as e:
+        print(f"   [!] US-имя не получено ({e}) — папки будут по имени витрин.")
+    return name
+
+
+def _listing_signature(task: dict) -> tuple:
+    """Отпечаток витрины: магазин, базовые пути скриншотов (по порядку) и видео."""
+    bases = tuple(get_base_image_path(u) for u in dedup_urls(task.get('raw_urls') or []))
+    return task['store'], bases, tuple(task.get('video_urls') or ())
+
+
+def _dedup_stage(registry: dict, lock: threading.Lock):
+    """Этап обхода между 'pages' и 'images': локаль с уже встреченной витриной
+    (те же скриншоты в том же порядке и те же видео) не качается — помечается
+    status 'duplicate' и 'same_as' (папка первой такой локали).
+    """
+    def check(task: dict) -> dict:
+        signature = _listing_signature(task)
+        if not signature[1]:
+            return task
+        with lock:
+            first = registry.setdefault(signature, task['folder'])
+        if first == task['folder']:
+            return task
+        print(f"   [=] {task['country'].upper()}: витрина совпадает с '{first}' — не качаю.")
+        return {**task, 'status': 'duplicate', 'same_as': first}
+    return check
+
+
+def _link_listing(src: str, dest: str) -> None:
+    """Папка dest = копия витрины из src: screen_*/preview_* ссылками, манифест — копией."""
+    os.makedirs(dest, exist_ok=True)
+    _clean_folder(dest, ('screen_', 'preview_'))
+    for fname in sorted(os.listdir(src)):
+        if fname.startswith(('screen_', 'preview_')):
+            _link_file(os.path.join(src, fname), os.path.join(dest, fname))
+    if os.path.exists(os.path.join(src, SYNC_STATE_FILE)):
+        shutil.copyfile(os.path.join(src, SYNC_STATE_FILE), os.path.join(dest, SYNC_STATE_FILE))
+
+
+def run_sweep(query: str, countries, stores: tuple[str, ...] = ('appstore',),
+              workers: int = BATCH_WORKERS, per_host: int = BATCH_PER_HOST,
+              report_path: str | None = None) -> list[dict]:
+    """Одно приложение по многим странам (список или 'all') в одном или обоих магазинах.
+
+    Каноническое имя папок определяется один раз (sweep_canonical_name), страны
+    идут параллельно через run_pipeline. Локали с одинаковой витриной
+    (сравниваются базовые пути скриншотов) определяются до загрузки: качается
+    только первая, остальным при SWEEP_LINK_DUPLICATES достаются ссылки на её
+    файлы. Если первая локаль не скачалась, её дубли качаются как обычно.
+    """
+    countries = _split_countries(countries)
+    stores = tuple(stores)
+    started = time.monotonic()
+    print(f"=== Обход: '{query}', стран {len(countries)}, "
+          f"магазины: {', '.join(stores)}, потоков {workers} ===")
+
+    if 'appstore' in stores and META_CACHE_ENABLED:
+        lookup_appstore_bulk([query], countries + ['us'])
+    name = sweep_canonical_name(query, stores)
+    if name:
+        print(f"   [i] Имя папок: {name}")
+
+    jobs = [{'query': query, 'store': store, 'country': country, 'folder_name': name}
+            for store in stores for country in countries]
+    registry: dict[tuple, str] = {}
+    dedup = _dedup_stage(registry, threading.Lock())
+    stages = list(PIPELINE_STAGES)
+    at = [n for n, _ in stages].index('images')
+    stages.insert(at, ('dedup', {store: dedup for store in STORE_HOSTS}))
+    results = run_pipeline(jobs, workers=workers, per_host=per_host, stages=tuple(stages))
+
+    # Дубли: ссылки на файлы первой локали или, если она не удалась, обычная загрузка
+    by_folder = {r['folder']: r for r in results if r['status'] == 'ok'}
+    retry = []
+    for i, r in enumerate(results):
+        if r['status'] != 'duplicate':
+            continue
+        first = by_folder.get(r['same_as'])
+        if first is None:
+            retry.append(i)
+        elif SWEEP_LINK_DUPLICATES:
+            _link_listing(first['folder'], r['folder'])
+            results[i] = {**r, 'status': 'ok',
+                          'images': first['images'], 'videos': first['videos']}
+        else:
+            results[i] = {**r, 'status': 'ok', 'folder': None, 'images': 0, 'videos': 0}
+    if retry:
+        again = run_pipeline([jobs[i] for i in retry], workers=workers, per_host=per_host)
+        for i, r in zip(retry, again):
+            results[i] = r
+
+    _finish_report(results, started, report_path)
+    return results
+
+
+# --- Очередь заданий ---
+
+QUEUE_PATH = os.path.join(CACHE_DIR, 'jobs.sqlite')
+QUEUE_MAX_ATTEMPTS = 3       # После стольких неудач задание остаётся failed (см. --requeue)
+QUEUE_RETRY_DELAY = 60       # Пауза перед повтором неудачного задания, с (× номер попытки)
+QUEUE_LEASE = 30 * 60        # Сколько задание считается занятым без продления, с
+
+# Этап конвейера -> ассет, чей статус записывается в очередь
+_QUEUE_ASSETS = {'images': 'image_failures', 'videos': 'video_failures'}
+# Настройки, которые флаги командной строки меняют и которые нужно передать
+# процессам-воркерам (spawn заново импортирует модуль со значениями по умолчанию)
+_WORKER_SETTINGS = (
+    'META_CACHE_ENABLED', 'BLOB_STORE_ENABLED', 'PHASH_ENABLED', 'PHASH_MODE',
+    'POSTPROCESS_ENABLED', 'POSTPROCESS_FORMATS', 'POSTPROCESS_SIZES',
+)
+
+
+class JobQueue:
+    """Устойчивая очередь заданий (приложение × магазин × страна) в SQLite.
+
+    Для каждого задания хранятся статус (pending/running/done/failed), число
+    попыток, итог и папка, для каждого ассета (images, videos) — статус, число
+    файлов и ошибки. Задания забираются атомарно (BEGIN IMMEDIATE), поэтому
+    из одной базы могут работать несколько процессов. Занятое задание держит
+    аренду (QUEUE_LEASE), которую продлевает воркер; если процесс упал, после
+    истечения аренды задание заберёт другой воркер. Перезапуск продолжает
+    только незавершённые и неудачные задания, а в них — только ассеты не в done.
+
+    Гранулярность очереди — тип ассета, не отдельный файл: пофайловое состояние
+    (ссылка, имя, ETag, хэш) лежит в манифесте .sync.json папки, и повтор
+    задания докачивает по нему только недостающее (incremental).
+    """
+
+    def __init__(self, path: str = QUEUE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # isolation_level=None — транзакции открываем сами (BEGIN IMMEDIATE)
+            self._db = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                       check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id INTEGER PRIMARY KEY, query TEXT NOT NULL, store TEXT NOT NULL,"
+                " country TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'pending',"
+                " attempts INTEGER NOT NULL DEFAULT 0, result TEXT, folder TEXT, error TEXT,"
+                " worker TEXT, lease_until REAL, not_before REAL NOT NULL DEFAULT 0,"
+                " updated_at REAL NOT NULL, UNIQUE (query, store, country))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS assets ("
+                " job_id INTEGER NOT NULL, asset TEXT NOT NULL,"
+                " status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,"
+                " output TEXT, count INTEGER NOT NULL DEFAULT 0, error TEXT,"
+                " updated_at REAL NOT NULL, PRIMARY KEY (job_id, asset))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, not_before)")
+        return self._db
+
+    def _write(self, fn):
+        """fn(db) в одной IMMEDIATE-транзакции (блокировка записи берётся сразу)."""
+        with self._lock:
+            db = self._conn()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(db)
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+            return result
+
+    def enqueue(self, jobs: list[dict]) -> int:
+        """Добавляет задания (дубли по (query, store, country) пропускаются). Возвращает число новых."""
+        now = time.time()
+
+        def insert(db) -> int:
+            added = 0
+            for job in jobs:
+                cur = db.execute(
+                    "INSERT OR IGNORE INTO jobs (query, store, country, updated_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    (job['query'], job['store'], job['country'], now),
+                )
+                if not cur.rowcount:
+                    continue
+                added += 1
+                assets = ('images', 'videos') if job['store'] == 'appstore' else ('images',)
+                db.executemany(
+                    "INSERT INTO assets (job_id, asset, updated_at) VALUES (?, ?, ?)",
+                    [(cur.lastrowid, asset, now) for asset in assets],
+                )
+            return added
+        return self._write(insert)
+
+    def claim(self, worker: str, max_attempts: int | None = None) -> dict | None:
+        """Атомарно забирает следующее задание: новое, неудачное (с попытками
+        в запасе и после паузы) или брошенное (аренда истекла). None — брать нечего.
+        """
+        now = time.time()
+        if max_attempts is None:
+            max_attempts = QUEUE_MAX_ATTEMPTS
+
+        def take(db) -> dict | None:
+            # Брошенные задания без попыток в запасе не перезапускаем по кругу
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, worker = NULL, lease_until = NULL,"
+                " updated_at = ? WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+                ('аренда истекла, попытки исчерпаны', now, now, max_attempts),
+            )
+            row = db.execute(
+                "SELECT id, query, store, country FROM jobs"
+                " WHERE (status = 'pending'"
+                "        OR (status = 'failed' AND attempts < ? AND not_before <= ?)"
+                "        OR (status = 'running' AND lease_until < ?))"
+                " ORDER BY attempts, id LIMIT 1",
+                (max_attempts, now, now),
+            ).fetchone()
+            if not row:
+                return None
+            db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?,"
+                " attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (worker, now + QUEUE_LEASE, now, row[0]),
+            )
+            done = [a for (a,) in db.execute(
+                "SELECT asset FROM assets WHERE job_id = ? AND status = 'done'", (row[0],))]
+            return {'id': row[0], 'query': row[1], 'store': row[2], 'country': row[3],
+                    'done_assets': done}
+        return self._write(take)
+
+    def renew(self, job_ids: list[int]) -> None:
+        """Продлевает аренду заданий, которые воркер ещё выполняет."""
+        if job_ids:
+            until = time.time() + QUEUE_LEASE
+            self._write(lambda db: db.executemany(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                [(until, i) for i in job_ids]))
+
+    def record_asset(self, job_id: int, asset: str, ok: bool, output: str | None,
+                     count: int, error: str | None = None) -> None:
+        now = time.time()
+        self._write(lambda db: db.execute(
+            "UPDATE assets SET status = ?, attempts = attempts + 1, output = ?, count = ?,"
+            " error = ?, updated_at = ? WHERE job_id = ? AND asset = ?",
+            ('done' if ok else 'failed', output, count, error, now, job_id, asset)))
+
+    def finish(self, job_id: int, result: str, folder: str | None, error: str | None) -> None:
+        """Закрывает задание: done, если всё получилось, иначе failed (будет повтор).
+
+        not_found тоже повторяется: get_*_data отдаёт None и при сетевой ошибке.
+        """
+        now = time.time()
+
+        def close(db) -> None:
+            (attempts,) = db.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            status = 'done' if result in ('ok', 'no_screenshots') and not error else 'failed'
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, folder = ?, error = ?, worker = NULL,"
+                " lease_until = NULL, not_before = ?, updated_at = ? WHERE id = ?",
+                (status, result, folder, error, now + QUEUE_RETRY_DELAY * attempts, now, job_id),
+            )
+        self._write(close)
+
+    def recover(self, host: str, max_attempts: int | None = None) -> int:
+        """Возвращает в очередь задания упавших процессов этого хоста (не дожидаясь аренды).
+
+        Задания, исчерпавшие max_attempts (по умолчанию QUEUE_MAX_ATTEMPTS),
+        вместо очереди помечаются failed. Возвращает число возвращённых.
+        """
+        if max_attempts is None:
+            max_attempts = QUEUE_MAX_ATTEMPTS
+
+        def release(db) -> int:
+            dead, exhausted = [], []
+            now = time.time()
+            for job_id, worker, attempts in db.execute(
+                    "SELECT id, worker, attempts FROM jobs WHERE status = 'running' AND worker LIKE ?",
+                    (f"{host}:%",)).fetchall():
+                try:
+                    os.kill(int(worker.rsplit(':', 1)[1]), 0)
+                except (ValueError, ProcessLookupError):
+                    (dead if attempts < max_attempts else exhausted).append(job_id)
+                except PermissionError:
+                    pass  # процесс жив, но чужой
+            db.executemany("UPDATE jobs SET status = 'pending', worker = NULL,"
+                           " lease_until = NULL WHERE id = ?", [(i,) for i in dead])
+            db.executemany("UPDATE jobs SET status = 'failed', error = ?, worker = NULL,"
+                           " lease_until = NULL, updated_at = ? WHERE id = ?",
+                           [('процесс воркера упал, попытки исчерпаны', now, i) for i in exhausted])
+            return len(dead)
+        return self._write(release)
+
+    def requeue_failed(self) -> int:
+        """Даёт исчерпавшим попытки заданиям ещё QUEUE_MAX_ATTEMPTS попыток."""
+        return self._write(lambda db: db.execute(
+            "UPDATE jobs SET status = 'pending', attempts = 0, not_before = 0"
+            " WHERE status = 'failed'").rowcount)
+
+    def next_retry_at(self, max_attempts: int | None = None) -> float | None:
+        """Когда станет доступен следующий отложенный повтор (или None — ждать нечего)."""
+        if max_attempts is None:
+            max_attempts = QUEUE_MAX_ATTEMPTS
+        with self._lock:
+            row = self._conn().execute(
+                "SELECT MIN(CASE WHEN status = 'running' THEN lease_until ELSE not_before END)"
+                " FROM jobs WHERE (status = 'failed' AND attempts < ?) OR status = 'running'",
+                (max_attempts,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"))
+
+
+def _run_queue_job(queue_db: JobQueue, job: dict) -> None:
+    """Выполняет одно задание очереди: этапы конвейера, пропуская ассеты в done.
+
+    Работает инкрементально — файлы прошлой (прерванной) попытки не удаляются,
+    докачивается только недостающее. Статус каждого ассета пишется в очередь.
+    """
+    task = {'store': job['store'], 'query': job['query'], 'country': job['country'],
+            'incremental': True, 'image_failures': [], 'video_failures': []}
+    error = None
+    try:
+        for name, handlers in PIPELINE_STAGES:
+            if 'status' in task:
+                break
+            handler = handlers.get(task['store'])
+            if not handler or name in job['done_assets']:
+                continue
+            task = handler(task)
+            if name in _QUEUE_ASSETS:
+                failures = task[_QUEUE_ASSETS[name]]
+                queue_db.record_asset(job['id'], name, not failures, task['folder'],
+                                      task.get(name, 0), '\n'.join(failures) or None)
+                if failures:
+                    error = f"{name}: не скачано {len(failures)}"
+    except Exception as e:
+        task = {**task, 'status': 'error'}
+        error = str(e)
+    result = _task_result(task)
+    queue_db.finish(job['id'], result['status'], result['folder'], error)
+    print(f"--- [очередь] {job['query']} / {job['store']} / {job['country']}: "
+          f"{result['status']}{f' ({error})' if error else ''}")
+
+
+def run_queue_worker(path: str = QUEUE_PATH, workers: int = BATCH_WORKERS,
+                     settings: dict | None = None) -> None:
+    """Воркер очереди: workers потоков забирают задания, пока они есть.
+
+    Отложенные повторы и чужие незавершённые задания дожидается; выходит,
+    когда брать больше нечего. Таких процессов можно запустить несколько.
+    settings — значения глобальных настроек из _WORKER_SETTINGS (для процессов).
+    """
+    import socket
+
+    if settings:
+        globals().update(settings)
+    queue_db = JobQueue(path)
+    host = socket.gethostname()
+    worker_id = f"{host}:{os.getpid()}"
+    recovered = queue_db.recover(host)
+    if recovered:
+        print(f"   [i] Возвращено в очередь заданий упавших процессов: {recovered}")
+
+    active: set[int] = set()
+    active_lock = threading.Lock()
+    stop = threading.Event()
+
+    def heartbeat() -> None:
+        while not stop.wait(QUEUE_LEASE / 3):
+            with active_lock:
+                ids = list(active)
+            queue_db.renew(ids)
+
+    def loop() -> None:
+        while True:
+            job = queue_db.claim(worker_id)
+            if job is None:
+                retry_at = queue_db.next_retry_at()
+                if retry_at is None:
+                    return
+                time.sleep(min(max(retry_at - time.time(), 1), 5))
+                continue
+            with active_lock:
+                active.add(job['id'])
+            try:
+                _run_queue_job(queue_db, job)
+            finally:
+                with active_lock:
+                    active.discard(job['id'])
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    threads = [threading.Thread(target=loop) for _ in range(max(1, workers))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stop.set()
+
+
+def run_queue(path: str, manifest_path: str | None = None, processes: int = 1,
+              workers: int = BATCH_WORKERS, requeue: bool = False) -> dict[str, int]:
+    """Очередь из командной строки: добавить задания манифеста и/или отработать их.
+
+    processes > 1 — столько процессов-воркеров (каждый с workers потоками).
+    Возвращает число заданий по статусам после прогона.
+    """
+    queue_db = JobQueue(path)
+    if manifest_path:
+        jobs = load_manifest(manifest_path)
+        print(f"=== Очередь {path}: добавлено заданий {queue_db.enqueue(jobs)} из {len(jobs)} ===")
+    if requeue:
+        print(f"   [i] Снова в очереди неудачных заданий: {queue_db.requeue_failed()}")
+
+    print(f"=== Очередь {path}: {queue_db.stats()} — процессов {processes}, потоков {workers} ===")
+    if processes > 1:
+        import multiprocessing
+        ctx = multiprocessing.get_context('spawn')
+        settings = {name: globals()[name] for name in _WORKER_SETTINGS}
+        procs = [ctx.Process(target=run_queue_worker, args=(path, workers, settings))
+                 for _ in range(processes)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+    else:
+        run_queue_worker(path, workers)
+
+    stats = queue_db.stats()
+    print(f"\n=== Очередь {path}: {stats} ===")
+    return stats
 
 
 # --- Главный цикл ---
 
-if __name__ == "__main__":
+def interactive() -> None:
+    """Интерактивный режим: по одному приложению/магазину/стране за запрос."""
     print("=== Screenshot Downloader v8.0 (App Store + Google Play) ===")
     print("    Значение в [скобках] — по умолчанию (просто нажмите Enter).\n")
 
@@ -495,11 +3176,112 @@ if __name__ == "__main__":
             print("[!] Неизвестный магазин. Используйте 'a' или 'g'.")
             continue
 
-        country_input = input("3. Страна (us, ru, de) [us]: ").strip().lower()
+        country_input = input("3. Страна (us, ru, de; несколько через пробел или all) [us]: ").strip().lower()
         if not country_input:
             country_input = 'us'
 
-        if store == 'appstore':
-            process_appstore(query, country_input)
+        countries = _split_countries(country_input)
+        if len(countries) > 1:
+            run_sweep(query, countries, stores=(store,))
+        elif store == 'appstore':
+            process_appstore(query, countries[0])
+        else:
+            process_gplay(query, countries[0])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Screenshot Downloader (App Store + Google Play)")
+    parser.add_argument('--batch', metavar='MANIFEST',
+                        help="манифест заданий (.csv/.json/.jsonl/.yaml) для пакетного режима")
+    parser.add_argument('--queue', metavar='PATH', nargs='?', const=QUEUE_PATH,
+                        help=f"устойчивая очередь в SQLite [{QUEUE_PATH}]: с --batch добавляет "
+                             f"задания манифеста, затем отрабатывает незавершённые")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="процессов-воркеров очереди (каждый с --workers потоками) [1]")
+    parser.add_argument('--requeue', action='store_true',
+                        help="дать заданиям очереди, исчерпавшим попытки, ещё попытки")
+    parser.add_argument('--sweep', metavar='QUERY',
+                        help="одно приложение по многим странам (см. --countries, --store)")
+    parser.add_argument('--countries', default='all',
+                        help="страны для --sweep через пробел/запятую или all [all]")
+    parser.add_argument('--store', default='a', choices=sorted(_STORE_ALIASES),
+                        help="магазин для --sweep: a, g или both [a]")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS,
+                        help=f"потоков на каждом этапе конвейера [{BATCH_WORKERS}]")
+    parser.add_argument('--per-host', type=int, default=BATCH_PER_HOST,
+                        help=f"лимит заданий одного магазина на этапе [{BATCH_PER_HOST}]")
+    parser.add_argument('--report', metavar='PATH', help="куда записать JSON-отчёт")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="не использовать кэш метаданных iTunes/Google Play")
+    parser.add_argument('--incremental', action='store_true',
+                        help="не чистить папки, а докачивать только изменившиеся файлы")
+    parser.add_argument('--blob-store', action='store_true',
+                        help="хранить одинаковые картинки один раз (жёсткие ссылки из .cache/blobs)")
+    parser.add_argument('--postprocess', action='store_true',
+                        help=f"после загрузки делать копии в {POSTPROCESS_DIR}/ (нужен Pillow)")
+    parser.add_argument('--formats', metavar='LIST',
+                        help=f"форматы копий через запятую: webp, avif, png, jpg "
+                             f"[{','.join(POSTPROCESS_FORMATS)}]")
+    parser.add_argument('--sizes', metavar='LIST',
+                        help=f"уменьшенные копии, длинная сторона в px через запятую "
+                             f"[{','.join(map(str, POSTPROCESS_SIZES))}]")
+    parser.add_argument('--phash', choices=('flag', 'drop'),
+                        help="искать почти одинаковые скриншоты (dHash, нужен Pillow): "
+                             "flag — пометить в .sync.json, drop — не сохранять")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="метрики прогона: *.prom — текстовый файл Prometheus, "
+                             "иначе JSON lines (спаны этапов + итоговая сводка)")
+    parser.add_argument('--profile', metavar='PATH',
+                        help="профиль cProfile всех потоков в PATH (python -m pstats PATH)")
+    args = parser.parse_args()
+
+    if args.blob_store:
+        BLOB_STORE_ENABLED = True
+
+    if args.incremental:
+        INCREMENTAL_SYNC = True
+
+    if args.no_cache:
+        META_CACHE_ENABLED = False
+
+    if args.phash:
+        PHASH_ENABLED = True
+        PHASH_MODE = args.phash
+
+    if args.postprocess:
+        POSTPROCESS_ENABLED = True
+    if args.formats:
+        POSTPROCESS_FORMATS = tuple(f.strip().lower() for f in args.formats.split(',') if f.strip())
+        unknown = set(POSTPROCESS_FORMATS) - set(_PIL_FORMATS)
+        if unknown:
+            parser.error(f"неизвестные форматы: {', '.join(sorted(unknown))}")
+    if args.sizes:
+        POSTPROCESS_SIZES = tuple(int(x) for x in args.sizes.split(',') if x.strip())
+
+    if args.metrics and not args.metrics.endswith('.prom'):
+        METRICS.open_jsonl(args.metrics)
+    profiler = ThreadProfiler() if args.profile else None
+    if profiler:
+        profiler.start()
+
+    try:
+        if args.queue:
+            run_queue(args.queue, manifest_path=args.batch, processes=args.processes,
+                      workers=args.workers, requeue=args.requeue)
+        elif args.batch:
+            run_batch(args.batch, workers=args.workers, per_host=args.per_host,
+                      report_path=args.report)
+        elif args.sweep:
+            run_sweep(args.sweep, args.countries, stores=_STORE_ALIASES[args.store],
+                      workers=args.workers, per_host=args.per_host, report_path=args.report)
         else:
-            process_gplay(query, country_input)
+            interactive()
+    finally:
+        if profiler:
+            profiler.stop(args.profile)
+            print(f"Профиль: {args.profile}")
+        if args.metrics:
+            METRICS.write(args.metrics)
+            print(f"Метрики: {args.metrics}")